@@ -9,9 +9,10 @@ from django.forms import ModelForm, PasswordInput
 from django.conf import settings
 
 import utils
+import plans
 from encrypted_fields import EncryptedCharField
 from models import DataConnection, Parameter, DataSet, Style, Report, ReportDataSet, \
-    DataSetParameter, Subscription
+    DataSetParameter, Subscription, SchedulerHeartbeat, ReportJob
 
 ### Hack to insert icons #######################################################
 # I want to show icons for each model in the admin, but I can't alter the admin 
@@ -104,12 +105,14 @@ class ReportAdmin(BaseAdmin):
                 ReportDataSet(report = obj, dataset = d.dataset, order_on_report = d.order_on_report)
                 for d in old_datasets]
             ReportDataSet.objects.bulk_create(new_datasets)
+        #bulk_create doesn't send post_save
+        plans.invalidate()
 
     duplicate.short_description = "Duplicate Selected Reports"
     actions = [duplicate]
 
 class SubscriptionAdmin(admin.ModelAdmin):
-    list_display = ('report', 'send_to', 'time', 'start_date', 'frequency', 'email_subject', 'last_scheduled_run','last_run_succeeded')
+    list_display = ('report', 'send_to', 'time', 'deliver_by', 'start_date', 'frequency', 'email_subject', 'last_scheduled_run','last_run_succeeded','next_run_at')
 
     def run_now(self, request, queryset):
         for obj in queryset:
@@ -130,10 +133,19 @@ class SubscriptionAdmin(admin.ModelAdmin):
 
     actions = [run_now, duplicate]
 
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ('report', 'user', 'status', 'created_at', 'finished_at')
+    list_filter = ('status',)
+
+class SchedulerHeartbeatAdmin(admin.ModelAdmin):
+    list_display = ('name', 'started_at', 'last_beat', 'running')
+
 admin.site.register(DataConnection,DataConnectionAdmin)
 admin.site.register(Parameter,ParameterAdmin)
 admin.site.register(DataSet,DataSetAdmin)
 admin.site.register(Style,StyleAdmin)
 admin.site.register(Report,ReportAdmin)
 admin.site.register(Subscription,SubscriptionAdmin)
+admin.site.register(SchedulerHeartbeat,SchedulerHeartbeatAdmin)
+admin.site.register(ReportJob,ReportJobAdmin)
 
@@ -0,0 +1,74 @@
+"""
+Column-oriented view of a dataset's results for python post processing.
+
+Scripts on datasets with columnar post processing turned on get, along with
+'data' (the rows):
+
+    columns = list of column names
+    table = dict of column name -> the column's values
+
+Values are NumPy arrays when NumPy is installed, so scripts can do vectorized
+math (table['price'] * table['qty'], table['qty'].cumsum(), etc.).  Otherwise
+numeric columns are array.array and everything else is a list.
+
+Scripts can write back either form: if 'data' is replaced, it's used as is.
+Otherwise, if 'table' or 'columns' were changed, the rows are rebuilt from 'table'
+in the order of 'columns'.  New columns added to 'table' but not to 'columns' go on
+the end, and columns removed from 'columns' are left out.  If neither was changed,
+'data' is used as the script left it (so scripts that edit 'data' in place, such as
+data.append(...), keep working).
+"""
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from maybe_safe_eval import safe_eval as maybe_safe_eval
+
+
+def _vector(values):
+    if numpy is not None:
+        return numpy.array(values)
+    if values and all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in values):
+        try:
+            return array.array('l', values)
+        except OverflowError:
+            return values
+    if values and all(isinstance(v, float) for v in values):
+        return array.array('d', values)
+    return values
+
+def to_table(data, columns):
+    """Turn rows into a dict of column name -> vector"""
+    values_by_column = zip(*data) if data else [()] * len(columns)
+    return dict((name, _vector(list(values))) for name, values in zip(columns, values_by_column))
+
+def _value(value):
+    #Hand back plain python values rather than numpy scalars
+    if numpy is not None and isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def to_rows(table, columns, original_columns=()):
+    """Turn a dict of column name -> vector back into rows, returning (rows, columns)"""
+    columns = list(columns) + sorted(name for name in table
+        if name not in columns and name not in original_columns)
+    vectors = [table[name] for name in columns]
+    rows = [tuple(_value(v) for v in row) for row in zip(*vectors)]
+    return rows, columns
+
+def post_process(code, data, columns, timeout_secs):
+    """Run post processing code with both row and column views of the data, and
+    return (data, columns) as the script left them."""
+    original_data, original_rows = data, list(data)
+    context = {'data': data, 'columns': list(columns), 'table': to_table(data, columns)}
+    maybe_safe_eval(code, context = context, timeout_secs = timeout_secs)
+    if context['data'] is not original_data:
+        return context['data'], context['columns']
+    rows, new_columns = to_rows(context['table'], context['columns'], columns)
+    if new_columns == list(columns) and rows == original_rows:
+        #'table' wasn't changed, keep any changes made to 'data' in place
+        return context['data'], context['columns']
+    return rows, new_columns
@@ -0,0 +1,160 @@
+"""
+Process-wide registry of pooled sqlalchemy engines, one per DataConnection.
+
+Building an engine means building a connection pool, so doing it for every query
+throws away every connection we open.  Instead each DataConnection gets one
+long-lived engine which is kept until the connection's settings change.
+"""
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import event, exc
+
+# DataConnection pk -> (settings key, engine)
+_engines = {}
+_lock = threading.Lock()
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pessimistic disconnect handling: test each connection as it's checked out
+    of the pool so a connection dropped by the server gets replaced instead of
+    failing the query.
+    See http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html#disconnect-handling-pessimistic"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        #Pool will retry with a fresh connection (up to three times)
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def _create_engine(connection):
+    kwargs = {}
+    #sqlite uses pools that don't accept sizing arguments
+    if connection.drivername != 'sqlite':
+        kwargs['pool_size'] = connection.pool_size
+        kwargs['max_overflow'] = connection.pool_max_overflow
+    if connection.pool_recycle is not None:
+        kwargs['pool_recycle'] = connection.pool_recycle
+    engine = sqlalchemy.create_engine(connection.get_url(), **kwargs)
+    if connection.pool_pre_ping:
+        event.listen(engine.pool, 'checkout', _ping_connection)
+    return engine
+
+
+def get_engine(connection):
+    """Return the pooled engine for a DataConnection, creating it if needed.
+
+    Engines are keyed on the connection's settings so a worker process notices
+    (and rebuilds) when another process saves new settings for the connection."""
+    key = connection.engine_key()
+    with _lock:
+        existing = _engines.get(connection.pk)
+        if existing and existing[0] == key:
+            return existing[1]
+        if existing:
+            existing[1].dispose()
+        engine = _create_engine(connection)
+        if connection.pk is not None:
+            _engines[connection.pk] = (key, engine)
+        return engine
+
+
+def dispose_engine(connection_id):
+    """Close all pooled connections for a DataConnection and forget its engine."""
+    with _lock:
+        existing = _engines.pop(connection_id, None)
+    if existing:
+        existing[1].dispose()
+
+
+def set_statement_timeout(conn, seconds):
+    """Have the database cancel statements run on conn that take longer than seconds.
+
+    Uses max_execution_time on MySQL (SELECTs only, MySQL 5.7.8+), statement_timeout
+    on PostgreSQL, and a progress handler that interrupts the query on sqlite.  Other
+    databases, and MySQL versions (or MariaDB) that don't have max_execution_time, are
+    left alone.  Returns a function to call when done with the connection which puts
+    it back the way it was.  See is_statement_timeout to recognize a cancelled query."""
+    ms = int(seconds * 1000)
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        set_sql = "SET SESSION max_execution_time = %d" % ms
+        undo_sql = "SET SESSION max_execution_time = 0"
+    elif dialect == 'postgresql':
+        set_sql = "SET statement_timeout = %d" % ms
+        undo_sql = "RESET statement_timeout"
+    elif dialect == 'sqlite':
+        raw_connection = conn.connection.connection
+        #The clock starts once the query is running, not when the connection was checked out
+        deadline = []
+        def progress():
+            now = time.time()
+            if not deadline:
+                deadline.append(now + seconds)
+            return now > deadline[0]
+        #Called every 1000 sqlite VM instructions, a non-zero return aborts the query
+        raw_connection.set_progress_handler(progress, 1000)
+        return lambda: raw_connection.set_progress_handler(None, 0)
+    else:
+        return lambda: None
+
+    try:
+        conn.execute(set_sql)
+    except exc.DBAPIError:
+        #Not supported by this server, run without a timeout
+        return lambda: None
+
+    def undo():
+        try:
+            conn.execute(undo_sql)
+        except Exception:
+            #Don't hand a connection with the timeout still set back to the pool
+            conn.invalidate()
+    return undo
+
+
+def is_statement_timeout(error):
+    """Whether a sqlalchemy DBAPIError is the database cancelling a statement for
+    running past the timeout from set_statement_timeout"""
+    orig = getattr(error, 'orig', None)
+    if orig is None:
+        return False
+    #PostgreSQL query_canceled
+    if getattr(orig, 'pgcode', None) == '57014':
+        return True
+    args = getattr(orig, 'args', ())
+    #MySQL ER_QUERY_TIMEOUT
+    if args and args[0] == 3024:
+        return True
+    #sqlite, when the progress handler aborts the query
+    return str(orig) == 'interrupted'
+
+
+def is_bad_sort_position(error):
+    """Whether a sqlalchemy DBAPIError is the database refusing an ORDER BY column
+    number past the last column"""
+    orig = getattr(error, 'orig', None)
+    if orig is None:
+        return False
+    #PostgreSQL invalid_column_reference ("ORDER BY position 9 is not in select list")
+    if getattr(orig, 'pgcode', None) == '42P10':
+        return True
+    message = str(orig)
+    args = getattr(orig, 'args', ())
+    #MySQL ER_BAD_FIELD_ERROR ("Unknown column '9' in 'order clause'")
+    if args and args[0] == 1054 and 'order clause' in message:
+        return True
+    #sqlite ("1st ORDER BY term out of range - should be between 1 and 5")
+    return 'ORDER BY term out of range' in message
+
+
+def dispose_all():
+    with _lock:
+        existing = _engines.values()
+        _engines.clear()
+    for key, engine in existing:
+        engine.dispose()
@@ -0,0 +1,13 @@
+"""
+Custom manage.py command to refresh the snapshots of materialized data sets.
+
+"""
+from django.core.management.base import BaseCommand
+from mr_reports.models import DataSetSnapshot
+
+class Command(BaseCommand):
+    help = 'Re-runs the queries of materialized data sets whose snapshots are due to be refreshed'
+
+    def handle(self, *args, **options):
+        count = DataSetSnapshot.refresh_due()
+        self.stdout.write("Refreshed %s snapshots" % count)
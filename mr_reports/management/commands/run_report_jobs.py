@@ -0,0 +1,61 @@
+"""
+Custom manage.py command to run reports queued to run in the background
+(see Report.run_in_background).
+
+"""
+import os
+import socket
+import time
+import traceback
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from mr_reports.models import ReportJob
+from mr_reports import sandbox
+
+#How often (in seconds) to delete old finished jobs when running with --wait
+PURGE_INTERVAL = 3600
+
+class Command(BaseCommand):
+    help = 'Runs reports that are waiting to run in the background'
+    option_list = BaseCommand.option_list + (
+        make_option('--wait', action='store_true', default=False,
+            help='Keep running and wait for more reports instead of exiting when there are none left.'),
+        make_option('--interval', type='float', default=1,
+            help='With --wait, how often (in seconds) to check for new reports (default 1).'),
+    )
+
+    def handle(self, *args, **options):
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+        #fork any sandbox workers before there are other threads
+        sandbox.start_pool()
+        last_purge = None
+        while True:
+            close_old_connections()
+            #Finished jobs hold on to their results, clear out old ones now and then
+            if last_purge is None or time.time() - last_purge > PURGE_INTERVAL:
+                purged = ReportJob.purge_old()
+                if purged:
+                    self.stdout.write("Deleted %s old jobs" % purged)
+                last_purge = time.time()
+            job = ReportJob.claim_next(worker)
+            if job is None:
+                if not options.get('wait'):
+                    break
+                time.sleep(options.get('interval') or 1)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        try:
+            job.run()
+        except Exception:
+            job.status = 'Failed'
+            job.error = traceback.format_exc()
+            job.finished_at = timezone.now()
+            job.save()
+            self.stdout.write("Hit error on job %s:\n%s" % (job.pk, job.error))
+        else:
+            self.stdout.write('Ran "%s" (job %s)' % (job.report, job.pk))
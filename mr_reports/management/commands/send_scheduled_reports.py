@@ -1,25 +1,155 @@
-
 """
 Custom manage.py command to send scheduled reports.
 
 """
+import itertools
+import os
+import signal
+import socket
+import threading
 import traceback
+from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
-from mr_reports.models import Subscription, Report
-from mr_reports.utils import execute_subscription
+from django.core.mail import get_connection
+from django.db import close_old_connections
+from django.db.models import Min
+from django.utils import timezone
+from mr_reports.models import Subscription, Report, SchedulerHeartbeat, run_in_parallel
+from mr_reports.utils import execute_subscription, subscription_group
+from mr_reports import engines, pdf, sandbox, scheduling
 
 class Command(BaseCommand):
     help = 'Emails the scheduled reports (subscriptions) that are ready to be sent'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=1,
+            help='Number of subscriptions to run at once (default 1). Several copies of this '
+                'command can also run at once, e.g. on different servers.'),
+        make_option('--daemon', action='store_true', default=False,
+            help='Keep running, sending subscriptions as they come due, instead of sending '
+                'what is due now and exiting. Stops cleanly on SIGTERM.'),
+        make_option('--interval', type='int', default=60,
+            help='With --daemon, the longest to sleep (in seconds) before checking for '
+                'new or changed subscriptions (default 60).'),
+    )
 
     def handle(self, *args, **options):
-        #Go through each schedule and determine if it's time to send it
-        for sched in Subscription.objects.all():
+        workers = options.get('workers') or 1
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+        self.output_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.next_planned_start = None
+        #fork any sandbox workers before there are other threads
+        sandbox.start_pool()
+
+        if options.get('daemon'):
+            self.run_daemon(workers, options.get('interval') or 60)
+        else:
+            self.run_once(workers)
+            self.stdout.write("Finished run")
+
+    def run_once(self, workers):
+        #One mail connection per thread, re-used for every email it sends
+        self.mail = threading.local()
+        self.mail_connections = []
+        try:
+            self.send_due(workers)
+        finally:
+            for mail_connection in self.mail_connections:
+                try:
+                    mail_connection.close()
+                except Exception:
+                    pass
+
+    def get_mail_connection(self):
+        if not hasattr(self.mail, 'connection'):
+            self.mail.connection = get_connection()
+            with self.output_lock:
+                self.mail_connections.append(self.mail.connection)
+        return self.mail.connection
+
+    def send_due(self, workers):
+        #Fill in next_run_at for any subscriptions saved before it existed
+        for sched in Subscription.objects.filter(next_run_at__isnull=True):
+            sched.save()
+        #Subscriptions for the same report and parameters share one PDF, so run them together
+        due = Subscription.objects.filter(next_run_at__lte=timezone.now())
+        subscriptions = sorted(due, key=subscription_group)
+        groups = [list(scheds) for group, scheds in itertools.groupby(subscriptions, key=subscription_group)]
+        #Subscriptions with a delivery window may wait for their planned start
+        groups, self.next_planned_start = scheduling.plan(groups, timezone.now())
+        if workers == 1:
+            for scheds in groups:
+                self.send_group(scheds)
+        else:
+            run_in_parallel([(self.send_group, (scheds,)) for scheds in groups], workers)
+
+    def send_group(self, scheds):
+        rendered = {}
+        #Each one is checked again under lock in case another runner just sent it
+        for sched in scheds:
+            if self.stopping.is_set():
+                #shutting down, leave the rest for next time
+                return
             try:
-                sent = execute_subscription(sched.id)
+                sent = execute_subscription(sched.id, rendered=rendered,
+                    mail_connection=self.get_mail_connection())
             except Exception, e:
-                self.stdout.write("Hit error on schedule: %s:" % sched)
-                self.stdout.write(traceback.format_exc())
+                self.write("Hit error on schedule: %s:\n%s" % (sched, traceback.format_exc()))
             else:
-                self.stdout.write('Attempted to send "%s". Was sent = %s' % (sched,sent))
-        self.stdout.write("Finished run")
+                self.write('Attempted to send "%s". Was sent = %s' % (sched,sent))
+            self.beat()
+
+    def run_daemon(self, workers, interval):
+        """Send subscriptions as they come due until stopped.  Database engines and the
+        PDF renderer stay warm between runs."""
+        def stop(signum, frame):
+            self.write("Received signal %s, finishing subscriptions in progress" % signum)
+            self.stopping.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        now = timezone.now()
+        self.heartbeat_name = '%s:%s' % (socket.gethostname(), os.getpid())
+        SchedulerHeartbeat.objects.filter(name=self.heartbeat_name).delete()
+        SchedulerHeartbeat.objects.create(name=self.heartbeat_name, started_at=now, last_beat=now)
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                self.beat()
+                try:
+                    self.run_once(workers)
+                except Exception:
+                    self.write("Hit error while sending subscriptions:\n%s" % traceback.format_exc())
+                self.beat()
+                self.stopping.wait(self.seconds_to_sleep(interval))
+        finally:
+            SchedulerHeartbeat.objects.filter(name=self.heartbeat_name).update(
+                last_beat=timezone.now(), running=False)
+            pdf.close_renderer()
+            engines.dispose_all()
+        self.stdout.write("Stopped")
+
+    def seconds_to_sleep(self, interval):
+        """Time until the next subscription comes due or is planned to start, at most
+        interval.  Subscriptions that are already overdue (failed, waiting on a busy
+        connection, or being sent elsewhere) wait a full interval."""
+        now = timezone.now()
+        next_run_at = Subscription.objects.filter(next_run_at__gt=now).aggregate(
+            Min('next_run_at'))['next_run_at__min']
+        if self.next_planned_start and (next_run_at is None or self.next_planned_start < next_run_at):
+            next_run_at = self.next_planned_start
+        if next_run_at is None:
+            return interval
+        seconds = (next_run_at - now).total_seconds()
+        return max(min(seconds, interval), 0.1)
+
+    def beat(self):
+        name = getattr(self, 'heartbeat_name', None)
+        if name:
+            SchedulerHeartbeat.objects.filter(name=name).update(last_beat=timezone.now())
+
+    def write(self, message):
+        with self.output_lock:
+            self.stdout.write(message)
@@ -18,6 +18,8 @@ be guaranteed to be safe.
 
 import inspect, compiler.ast
 import thread, time
+import hashlib, threading, heapq, ctypes
+from collections import OrderedDict
 
 #----------------------------------------------------------------------
 # Module globals.
@@ -26,6 +28,9 @@ import thread, time
 # Toggle module level debugging mode.
 DEBUG = False
 
+# How many validated and compiled code objects to keep around.
+CODE_CACHE_SIZE = 256
+
 # List of all AST node classes in compiler/ast.py.
 all_ast_nodes = \
     [name for (name, obj) in inspect.getmembers(compiler.ast)
@@ -324,6 +329,141 @@ class SafeEvalTimeoutException(SafeEvalException):
     def __str__(self):
         return "Timeout limit execeeded (%s secs) during exec" % self.timeout
 
+#----------------------------------------------------------------------
+# Compiled code cache.
+#----------------------------------------------------------------------
+
+class CodeCache(object):
+    """
+    LRU cache of code objects which already passed validation, keyed on
+    a hash of their source. Lets repeat evaluations of the same source
+    skip parsing, checking and compiling.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, code):
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        return hashlib.sha1(code).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            compiled = self.entries.pop(key, None)
+            if compiled is not None:
+                # re-insert as most recently used
+                self.entries[key] = compiled
+            return compiled
+
+    def put(self, key, compiled):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = compiled
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+code_cache = CodeCache(CODE_CACHE_SIZE)
+
+def compile_safe(code):
+    """
+    Return a compiled code object for 'code', validating it first
+    unless it's already in the cache. SafeEvalCodeException is raised
+    if code didn't validate.
+    """
+    key = code_cache.key(code)
+    compiled = code_cache.get(key)
+    if compiled is None:
+        ast = compiler.parse(code)
+        checker = SafeEvalVisitor()
+        if not checker.walk(ast):
+            raise SafeEvalCodeException(code, checker.errors)
+        compiled = compile(code, '<safe_eval>', 'exec')
+        code_cache.put(key, compiled)
+    return compiled
+
+#----------------------------------------------------------------------
+# Timeout watchdog.
+#----------------------------------------------------------------------
+
+class SafeEvalInterrupt(BaseException):
+    "Raised asynchronously in a thread whose evaluation overran its deadline."
+    pass
+
+def _set_async_exc(thread_id, exc):
+    "Raise 'exc' in the given thread, or clear a pending one if exc is None."
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread_id),
+        ctypes.py_object(exc) if exc is not None else None)
+
+class _Deadline(object):
+    def __init__(self, thread_id, when):
+        self.thread_id, self.when = thread_id, when
+        self.done = self.fired = False
+
+class Watchdog(object):
+    """
+    A single long-lived thread which tracks the deadlines of all
+    in-flight evaluations and interrupts only the thread that overran,
+    by raising SafeEvalInterrupt in it. Safe to use from any thread.
+
+    Note the interrupt is only noticed between Python bytecodes, so code
+    stuck in a long blocking call is interrupted when that call returns.
+    """
+    def __init__(self):
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def _start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='safe_eval watchdog')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def watch(self, timeout_secs):
+        "Start tracking a deadline for the current thread."
+        deadline = _Deadline(thread.get_ident(), time.time() + timeout_secs)
+        with self.condition:
+            self._start()
+            heapq.heappush(self.deadlines, (deadline.when, id(deadline), deadline))
+            self.condition.notify()
+        return deadline
+
+    def unwatch(self, deadline):
+        """
+        Stop tracking a deadline. Returns True if it had already fired, in
+        which case any interrupt not yet delivered is cancelled.
+        """
+        with self.condition:
+            deadline.done = True
+            if deadline.fired:
+                _set_async_exc(deadline.thread_id, None)
+            return deadline.fired
+
+    def _run(self):
+        with self.condition:
+            while True:
+                # finished deadlines are dropped lazily
+                while self.deadlines and self.deadlines[0][2].done:
+                    heapq.heappop(self.deadlines)
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+                wait = self.deadlines[0][0] - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                deadline = heapq.heappop(self.deadlines)[2]
+                deadline.fired = True
+                _set_async_exc(deadline.thread_id, SafeEvalInterrupt)
+
+watchdog = Watchdog()
+
 def exec_timed(code, context, timeout_secs):
     """
     Dynamically execute 'code' using 'context' as the global enviroment.
@@ -332,22 +472,13 @@ def exec_timed(code, context, timeout_secs):
     """
     assert(timeout_secs > 0)
 
-    signal_finished = False
-    
-    def alarm(secs):
-        def wait(secs):
-            for n in xrange(timeout_secs):
-                time.sleep(1)
-                if signal_finished: break
-            else:
-                thread.interrupt_main()
-        thread.start_new_thread(wait, (secs,))
-
+    deadline = watchdog.watch(timeout_secs)
     try:
-        alarm(timeout_secs)
-        exec code in context
-        signal_finished = True
-    except KeyboardInterrupt:
+        try:
+            exec code in context
+        finally:
+            watchdog.unwatch(deadline)
+    except SafeEvalInterrupt:
         raise SafeEvalTimeoutException(timeout_secs)
 
 def safe_eval(code, context = {}, timeout_secs = 5):
@@ -385,13 +516,7 @@ def safe_eval(code, context = {}, timeout_secs = 5):
     if ctx_errors:
         raise SafeEvalContextException(ctx_errkeys, ctx_errors)
 
-    ast = compiler.parse(code)
-    checker = SafeEvalVisitor()
-
-    if checker.walk(ast):
-        exec_timed(code, context, timeout_secs)
-    else:
-        raise SafeEvalCodeException(code, checker.errors)
+    exec_timed(compile_safe(code), context, timeout_secs)
        
 #----------------------------------------------------------------------
 # Basic tests.
@@ -431,12 +556,39 @@ class TestSafeEval(unittest.TestCase):
         self.assertRaises(SafeEvalException, \
             safe_eval, "while 1: pass")
 
+    def test_timeout_exceed_in_thread(self):
+        # only the thread that overran is interrupted
+        errors = []
+        def run():
+            try:
+                safe_eval("while 1: pass", timeout_secs = 0.5)
+            except SafeEvalTimeoutException, e:
+                errors.append(e)
+        worker = threading.Thread(target=run)
+        worker.start()
+        worker.join(5)
+        self.assertEqual(len(errors), 1)
+        # the main thread carried on untouched
+        safe_eval("x = 1", {}, timeout_secs = 1)
+
     def test_invalid_context(self):
         # can't pass an enviroment with modules or builtins
         env = {'f' : __builtins__.open, 'g' : time}
         self.assertRaises(SafeEvalException, \
             safe_eval, "print 1", env)
 
+    def test_code_cache(self):
+        # repeat evaluations re-use the compiled code
+        code_cache.clear()
+        env = {}
+        safe_eval("x = 1", env)
+        compiled = code_cache.get(code_cache.key("x = 1"))
+        self.assertTrue(compiled is not None)
+        self.assertTrue(compile_safe("x = 1") is compiled)
+        # unsafe code is never cached
+        self.assertRaises(SafeEvalException, safe_eval, "open('test.txt')")
+        self.assertEqual(code_cache.get(code_cache.key("open('test.txt')")), None)
+
     def test_callback(self):
         # modify local variable via callback
         self.value = 0
@@ -7,7 +7,6 @@ Allow datasets for parameters ...?
 Ability to log out for normal users
 Categories
 advanced permissions
-pagination, sorting
 Better handling of parameters for subscriptions, they're error prone and not
     user friendly.  I think I could include and validate each parameter within
     a subscription form.  See http://stackoverflow.com/questions/4727732/django-add-field-to-model-formset
@@ -21,7 +20,15 @@ South:
 import datetime
 import re
 import ast
+import copy
+import hashlib
+import logging
+import sys
+import threading
+import Queue
+import cPickle
 
+from django import db
 from django.db import models
 from django.contrib.auth.models import Group, User
 from django.utils.safestring import mark_safe
@@ -30,13 +37,21 @@ from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils import timezone
+from django.core.cache import get_cache
+from django.http import QueryDict
+from dateutil.relativedelta import relativedelta
 
 from encrypted_fields import EncryptedCharField
+import engines
+import sandbox
+import columnar
+from resultset import ResultSet
 import sqlalchemy
 from sqlalchemy.sql import text
 
 from maybe_safe_eval import safe_eval as maybe_safe_eval
 
+logger = logging.getLogger(__name__)
 
 class AuditableTable(models.Model):
     """A basic abstract table to save timestamp info when object is created or 
@@ -74,8 +89,27 @@ class DataConnection(AuditableTable):
     host = models.CharField(max_length=300, help_text="The name of the host", blank=True)
     port = models.IntegerField(help_text="The port number", null=True, blank=True)
     database = models.CharField(max_length=300, help_text="The database name")
+    #Connection pool settings (see http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html)
+    pool_size = models.PositiveIntegerField(default=5,
+        help_text="Number of connections to keep open to this database per web server process. "
+        "(Ignored for sqlite)")
+    pool_max_overflow = models.PositiveIntegerField(default=10,
+        help_text="Number of extra connections allowed beyond the pool size when the pool is busy. "
+        "(Ignored for sqlite)")
+    pool_recycle = models.IntegerField(null=True, blank=True, default=3600,
+        help_text="Replace connections after they have been open this many seconds. Set this below "
+        "your database's idle timeout (for example MySQL's wait_timeout). Leave blank to never recycle.")
+    pool_pre_ping = models.BooleanField(default=True,
+        help_text="Test each connection before using it so dropped connections are replaced "
+        "instead of failing the report.")
+    query_timeout_seconds = models.PositiveIntegerField(null=True, blank=True,
+        help_text="Cancel queries on this connection that take longer than this many seconds. "
+        "Supported for MySQL (5.7.8+), PostgreSQL and sqlite. Data sets can override this.")
+    max_concurrent_subscriptions = models.PositiveIntegerField(null=True, blank=True,
+        help_text="Most subscriptions using this connection to send at once (across all "
+        "subscription runners). Leave blank for no limit.")
 
-    def get_db_connection(self):
+    def get_url(self):
         url = sqlalchemy.engine.url.URL(drivername=self.drivername, username=self.username or None,
             password=self.password or None, host=self.host or None, port=self.port or None, database=self.database)
         #Sqlalchemy doesn't seem to let us specify dialect in URL, I guess we have to hack it in??
@@ -83,12 +117,38 @@ class DataConnection(AuditableTable):
         if self.dialect:
             drivername,the_rest = str(url).split('://')
             s_url = drivername + '+' + self.dialect + '://' + the_rest
-        engine = sqlalchemy.create_engine(s_url)
-        return engine.connect()
+        return s_url
+
+    def engine_key(self):
+        """Everything that goes into building this connection's engine"""
+        return (self.get_url(), self.pool_size, self.pool_max_overflow, self.pool_recycle,
+            self.pool_pre_ping)
+
+    def get_engine(self):
+        """Long-lived pooled engine for this connection, shared by the whole process"""
+        return engines.get_engine(self)
+
+    def get_db_connection(self):
+        """Check out a connection from the pool.  Make sure to close() it when done
+        so it's returned to the pool."""
+        return self.get_engine().connect()
+
+    def save(self, *args, **kwargs):
+        super(DataConnection, self).save(*args, **kwargs)
+        #Settings may have changed so rebuild the engine next time it's needed
+        engines.dispose_engine(self.pk)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        super(DataConnection, self).delete(*args, **kwargs)
+        engines.dispose_engine(pk)
 
     def __unicode__(self):
         return "%s@%s/%s (%s)" % (self.username, self.host, self.database, self.drivername)
 
+#How many rows to pull from the database at a time when streaming results
+FETCH_BATCH_SIZE = 1000
+
 def totwotuple(tupl): #convenience function
     return tuple([tuple([item]*2) for item in tupl])
 class Parameter(AuditableTable):
@@ -140,6 +200,12 @@ class Parameter(AuditableTable):
     def __unicode__(self):
         return self.name
 
+class QueryTimeout(Exception):
+    """A dataset's query was cancelled for running longer than its timeout"""
+    def __init__(self, timeout):
+        super(QueryTimeout, self).__init__("Query cancelled after %s seconds" % timeout)
+        self.timeout = timeout
+
 class DataSet(AuditableTable):
     """A query to pull data"""
     name = models.CharField(max_length=50)
@@ -151,29 +217,392 @@ class DataSet(AuditableTable):
     python_post_processing = models.TextField(help_text="Optional python code. Your code will have access to a list of lists called 'data' "
         "with all of the data.  Modify this as you see fit.",
         blank=True)
+    columnar_post_processing = models.BooleanField(default=False,
+        help_text="Also give post processing code the data by column: 'columns' (a list of column names) and "
+        "'table' (a dict of column name to values, as NumPy arrays if NumPy is installed). Change either "
+        "'data' or 'table' and 'columns' to change the results.")
+    cache_seconds = models.PositiveIntegerField("Cache results for (seconds)", default=0,
+        help_text="Re-use results for the same parameters for this many seconds instead of re-running "
+        "the query. 0 turns caching off.")
+    materialized = models.BooleanField(default=False,
+        help_text="Keep a snapshot of the results in the reports database and show that instead of "
+        "running the query on each page load. Good for slow queries on data that only changes now and "
+        "then. A snapshot is taken the first time each set of parameters is used, and refreshed by the "
+        "refresh_snapshots command.")
+    snapshot_refresh_time = models.TimeField(null=True, blank=True,
+        help_text="For materialized data sets (required), refresh snapshots once a day at this time, for "
+        "example after the source data is loaded each night.")
+    page_size = models.PositiveIntegerField(default=0,
+        help_text="Show this many rows at a time on the report, with links to the next and previous "
+        "pages. Only one page is pulled from the database at a time. 0 shows all rows. "
+        "(Ignored when using python post processing, and for PDF and CSV exports.)")
+    sortable = models.BooleanField(default=False,
+        help_text="Let users sort the table by clicking on column headings. Sorting is done by the database. "
+        "(Ignored when using python post processing, unless the data set is materialized.)")
+    max_rows = models.PositiveIntegerField(null=True, blank=True,
+        help_text="Stop after this many rows and show a message that the results were cut off. "
+        "Leave blank to use the MR_REPORTS_MAX_ROWS setting.")
+    max_memory_mb = models.PositiveIntegerField("Max memory (MB)", null=True, blank=True,
+        help_text="Stop once the results take up roughly this much memory on the web server. "
+        "Leave blank to use the MR_REPORTS_MAX_MEMORY_MB setting.")
+    csv_max_rows = models.PositiveIntegerField("CSV max rows", null=True, blank=True,
+        help_text="Like max rows, but for CSV downloads. "
+        "Leave blank to use the MR_REPORTS_CSV_MAX_ROWS setting.")
+    timeout_seconds = models.PositiveIntegerField(null=True, blank=True,
+        help_text="Cancel the query if it takes longer than this many seconds. "
+        "Leave blank to use the data connection's timeout.")
+
+    #Set by run_query when results came from the cache
+    cached_at = None
+    #Which page and sort column to pull, see set_table_state
+    page = None
+    sort = None
+    #Set by run_query when paginating
+    has_next_page = False
+    #Set by iter_query to use the CSV row limit
+    export_csv = False
+    #Set when results were cut off by a row or memory limit
+    truncated_at = None
+    #Set by run_query to when the snapshot was taken, for materialized data sets
+    snapshot_at = None
+    #Set by run_for_report to the timeout when the query was cancelled
+    timed_out = None
+
+    def get_timeout(self):
+        return self.timeout_seconds or self.connection.query_timeout_seconds
+
+    def row_limits(self):
+        """(max rows, max bytes) for this dataset's results, or None for no limit"""
+        if self.export_csv:
+            max_rows = self.csv_max_rows or getattr(settings, 'MR_REPORTS_CSV_MAX_ROWS', None)
+        else:
+            max_rows = self.max_rows or getattr(settings, 'MR_REPORTS_MAX_ROWS', None)
+        max_mb = self.max_memory_mb or getattr(settings, 'MR_REPORTS_MAX_MEMORY_MB', None)
+        return max_rows, (max_mb * 1024 * 1024 if max_mb else None)
+
+    def page_param(self):
+        return 'page_%s' % self.id
+
+    def sort_param(self):
+        return 'sort_%s' % self.id
 
-    def run_query(self, submitted_parameters):
-        conn = self.connection.get_db_connection() #TODO: re-use across object
-        query = text(self.query)
+    def set_table_state(self, table_state, paginate=True):
+        """Pick up which page and sort column to pull from table_state, a dict
+        such as request.GET.  Sort is a 1-based column number, negative for
+        descending."""
+        self.page, self.sort = None, None
+        if paginate and self.page_size and not self.has_post_processing():
+            try:
+                self.page = max(int(table_state.get(self.page_param(), 1)), 1)
+            except ValueError:
+                self.page = 1
+        if self.can_sort():
+            try:
+                self.sort = int(table_state.get(self.sort_param(), '')) or None
+            except ValueError:
+                pass
+
+    def can_sort(self):
+        """Whether users can sort the table.  The database sorts the query's own columns,
+        which post processing may have changed, so only materialized datasets (sorted
+        here from the stored results) can be sorted when there's post processing."""
+        return self.sortable and (self.materialized or not self.has_post_processing())
+
+    def cache_key(self, submitted_parameters):
+        """Cache key for this dataset's results with the given parameters.  Includes
+        when the dataset and its connection were last saved, so editing either one
+        invalidates cached results."""
         if submitted_parameters:
-            result = conn.execute(query, **submitted_parameters.cleaned_data)
+            parameters = sorted(submitted_parameters.cleaned_data.items())
         else:
-            result = conn.execute(query)
+            parameters = []
+        key_data = repr((self.query, self.connection_id, self.updated_datetime,
+            self.connection.updated_datetime, parameters, self.page, self.sort, self.row_limits()))
+        return 'mr_reports:dataset:%s:%s' % (self.id, hashlib.md5(key_data).hexdigest())
+
+    def run_query(self, submitted_parameters, use_cache=True):
+        """Return (data, columns), from the cache if possible.  Set use_cache to
+        False to re-run the query and refresh the cache."""
+        self.cached_at = None
+        self.snapshot_at = None
+        if self.materialized:
+            return self.run_snapshot(submitted_parameters, use_cache)
+        if self.cache_seconds:
+            cache = get_cache(getattr(settings, 'MR_REPORTS_CACHE', 'default'))
+            key = self.cache_key(submitted_parameters)
+            if use_cache:
+                cached = cache.get(key)
+                if cached is not None:
+                    self.cached_at, data, columns, self.has_next_page, self.truncated_at = cached
+                    return data, columns
+
+        data, columns = self.execute_query(submitted_parameters)
+
+        if self.cache_seconds:
+            #store plain tuples rather than whatever post processing returned
+            if not isinstance(data, ResultSet):
+                data = [tuple(row) for row in data]
+            cache.set(key, (timezone.now(), data, columns, self.has_next_page, self.truncated_at),
+                self.cache_seconds)
+        return data, columns
+
+    def snapshot_key(self, submitted_parameters):
+        if submitted_parameters:
+            parameters = sorted(submitted_parameters.cleaned_data.items())
+        else:
+            parameters = []
+        return hashlib.sha1(repr(parameters)).hexdigest()
+
+    def take_snapshot(self, submitted_parameters, used=True):
+        """Run the query and store the whole result (not just the current page) as this
+        dataset's snapshot for these parameters.  Set used to False for refreshes that
+        aren't for someone looking at the report.
+
+        Snapshots keep rows up to the CSV limits, so they can be exported too, and are
+        cut down to the web limits when read (see run_snapshot)."""
+        page, sort, export_csv = self.page, self.sort, self.export_csv
+        self.page, self.sort, self.export_csv = None, None, True
+        try:
+            data, columns = self.execute_query(submitted_parameters)
+        finally:
+            self.page, self.sort, self.export_csv = page, sort, export_csv
+        if not isinstance(data, ResultSet):
+            data = [tuple(row) for row in data]
+        fields = {
+            'parameters': cPickle.dumps(submitted_parameters.cleaned_data if submitted_parameters else None,
+                cPickle.HIGHEST_PROTOCOL),
+            'result': cPickle.dumps((data, columns), cPickle.HIGHEST_PROTOCOL),
+            'truncated_at': self.truncated_at,
+            'refreshed_at': timezone.now(),
+            'refresh_failed_at': None,
+        }
+        if used:
+            fields['last_used_at'] = fields['refreshed_at']
+        key = self.snapshot_key(submitted_parameters)
+        try:
+            with db.transaction.atomic():
+                if not DataSetSnapshot.objects.filter(dataset=self, key=key).update(**fields):
+                    fields.setdefault('last_used_at', fields['refreshed_at'])
+                    DataSetSnapshot.objects.create(dataset=self, key=key, **fields)
+        except db.IntegrityError:
+            #another process just stored the same snapshot
+            pass
+        return fields['refreshed_at'], data, columns
+
+    def run_snapshot(self, submitted_parameters, use_cache=True):
+        """run_query for materialized datasets: read the stored snapshot (taking it
+        first if there isn't a current one) and sort and page it here"""
+        snapshot = None
+        if use_cache:
+            snapshot = DataSetSnapshot.objects.filter(dataset=self, key=self.snapshot_key(submitted_parameters),
+                refreshed_at__gte=self.updated_datetime).first()
+        if snapshot:
+            self.snapshot_at, self.truncated_at = snapshot.refreshed_at, snapshot.truncated_at
+            data, columns = snapshot.get_result()
+            snapshot.mark_used()
+        else:
+            self.snapshot_at, data, columns = self.take_snapshot(submitted_parameters)
+        if self.sort and abs(self.sort) <= len(columns):
+            i = abs(self.sort) - 1
+            data = sorted(data, key=lambda row: (row[i] is not None, row[i]), reverse=self.sort < 0)
+        max_rows = self.row_limits()[0]
+        if max_rows and len(data) > max_rows:
+            data = data[:max_rows]
+            self.truncated_at = max_rows
+        self.has_next_page = False
+        if self.page:
+            start = (self.page - 1) * self.page_size
+            self.has_next_page = len(data) > start + self.page_size
+            data = data[start:start + self.page_size]
+        return data, columns
+
+    def build_query(self):
+        """Return the SQL to run and any extra bind parameters it needs.  When sorting,
+        paginating or limiting rows, the dataset's query is wrapped in an outer query so
+        only the requested rows are pulled from the database."""
+        max_rows = self.row_limits()[0]
+        if not (self.page or self.sort or max_rows):
+            return self.query, {}
+        sql = "SELECT * FROM (\n%s\n) mr_reports_table" % self.query.strip().rstrip(';')
+        extra_parameters = {}
+        if self.sort:
+            #Sort by column position so no user input goes into the SQL
+            sql += " ORDER BY %d%s" % (abs(self.sort), ' DESC' if self.sort < 0 else '')
+        if self.page:
+            #Pull one extra row to find out whether there's a next page
+            sql += " LIMIT :mr_reports_limit OFFSET :mr_reports_offset"
+            extra_parameters = {'mr_reports_limit': self.page_size + 1,
+                'mr_reports_offset': (self.page - 1) * self.page_size}
+        elif max_rows:
+            #One extra row shows the results were cut off.  Limiting in the database also
+            #means closing the cursor early doesn't have to read through the rest.
+            sql += " LIMIT :mr_reports_limit"
+            extra_parameters = {'mr_reports_limit': max_rows + 1}
+        return sql, extra_parameters
 
-        columns = [item[0] for item in result.cursor.description]        
-        data = result.fetchall()
+    def _execute(self, conn, submitted_parameters):
+        try:
+            return self._execute_sql(conn, submitted_parameters)
+        except sqlalchemy.exc.DBAPIError, e:
+            if not self.sort or not engines.is_bad_sort_position(e):
+                raise
+            #The sort column comes from the query string and may be past the last
+            #column, so try again unsorted rather than failing the report
+            self.sort = None
+            return self._execute_sql(conn, submitted_parameters)
+
+    def _execute_sql(self, conn, submitted_parameters):
+        sql, query_parameters = self.build_query()
+        if submitted_parameters:
+            query_parameters.update(submitted_parameters.cleaned_data)
+        try:
+            return conn.execute(text(sql), **query_parameters)
+        except sqlalchemy.exc.DBAPIError, e:
+            self._check_timeout(e)
+            raise
+
+    def _check_timeout(self, error):
+        """Raise QueryTimeout if error is the database cancelling the query for running
+        past its timeout.  Queries can be cancelled while running or while fetching."""
+        timeout = self.get_timeout()
+        if timeout and engines.is_statement_timeout(error):
+            raise QueryTimeout(timeout)
+
+    def _connect(self, stream_results=False):
+        """Check out a connection with this dataset's timeout applied.  Returns
+        (connection, function to call when done with it)."""
+        conn = self.connection.get_db_connection()
+        if stream_results:
+            conn = conn.execution_options(stream_results=True)
+        timeout = self.get_timeout()
+        reset_timeout = engines.set_statement_timeout(conn, timeout) if timeout else None
+        def close():
+            try:
+                if reset_timeout:
+                    reset_timeout()
+            finally:
+                #return connection to the pool
+                conn.close()
+        return conn, close
+
+    def has_post_processing(self):
+        return bool(self.python_post_processing and
+            getattr(settings,'MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER',False))
+
+    def execute_query(self, submitted_parameters):
+        """Run the query (and any post processing) against the data connection"""
+        max_rows, max_bytes = self.row_limits()
+        #Without streaming most drivers load the whole result into memory before we see it
+        conn, close = self._connect(stream_results=bool(max_rows or max_bytes))
+        try:
+            result = self._execute(conn, submitted_parameters)
+            try:
+                columns = [item[0] for item in result.cursor.description]
+                data, truncated = ResultSet.from_result(result, columns, FETCH_BATCH_SIZE, max_rows, max_bytes)
+            except sqlalchemy.exc.DBAPIError, e:
+                self._check_timeout(e)
+                raise
+            finally:
+                #A streaming cursor left with unread rows can't run anything else (such as
+                #resetting the timeout), so close it first
+                result.close()
+        finally:
+            close()
+        self.truncated_at = len(data) if truncated else None
+
+        self.has_next_page = False
+        if self.page:
+            self.has_next_page = len(data) > self.page_size
+            data = data[:self.page_size]
 
         #Python post processing on data (if any)
-        if self.python_post_processing and getattr(settings,'MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER',False):
+        if self.has_post_processing():
+            #scripts get a list of rows they can change
+            data = list(data)
             context = {'data':data}
        	    #Django saves newlines with	\r\n, but to eval we just want \n (or we'll get	a syntax error)
       	    code_to_run	= self.python_post_processing.replace('\r\n','\n')
-            maybe_safe_eval(code_to_run, context = context, timeout_secs = 10)
-            #pull out calculated default value
-            data = context['data']
+            timeout_secs = getattr(settings, 'MR_REPORTS_POST_PROCESSING_TIMEOUT', 10)
+            if getattr(settings, 'MR_REPORTS_SANDBOX_WORKERS', 0):
+                #run in a separate, resource limited process
+                data, columns = sandbox.post_process(code_to_run, data, columns, timeout_secs = timeout_secs,
+                    columnar = self.columnar_post_processing)
+            elif self.columnar_post_processing:
+                data, columns = columnar.post_process(code_to_run, data, columns, timeout_secs = timeout_secs)
+            else:
+                maybe_safe_eval(code_to_run, context = context, timeout_secs = timeout_secs)
+                #pull out calculated default value
+                data = context['data']
 
         return data, columns
 
+    def iter_query(self, submitted_parameters, use_cache=True):
+        """Like run_query, but returns (rows, columns) where rows is an iterator that
+        fetches from the database in batches as it's consumed, so memory use stays flat
+        for large results.  (Uses a server-side cursor where the driver supports one.)
+
+        Datasets with post processing or caching need the whole result at once so
+        those fall back to run_query."""
+        self.export_csv = True
+        if self.has_post_processing() or self.cache_seconds or self.materialized:
+            data, columns = self.run_query(submitted_parameters, use_cache)
+            return iter(data), columns
+
+        self.cached_at = None
+        self.truncated_at = None
+        max_rows = self.row_limits()[0]
+        conn, close = self._connect(stream_results=True)
+        try:
+            result = self._execute(conn, submitted_parameters)
+            columns = [item[0] for item in result.cursor.description]
+        except:
+            close()
+            raise
+
+        def rows():
+            fetched = 0
+            try:
+                while True:
+                    try:
+                        batch = result.fetchmany(FETCH_BATCH_SIZE)
+                    except sqlalchemy.exc.DBAPIError, e:
+                        try:
+                            self._check_timeout(e)
+                        except QueryTimeout, timeout:
+                            #the rows so far have already gone out, so end with the timeout message
+                            self.timed_out = timeout.timeout
+                            return
+                        raise
+                    if not batch:
+                        break
+                    for row in batch:
+                        if max_rows and fetched >= max_rows:
+                            self.truncated_at = fetched
+                            return
+                        fetched += 1
+                        yield row
+            finally:
+                try:
+                    result.close()
+                finally:
+                    close()
+        return rows(), columns
+
+    def run_for_report(self, submitted_parameters, use_cache=True):
+        """run_query, except a query that times out gives no data and sets timed_out
+        (so the report can say so) instead of failing the whole report"""
+        self.timed_out = None
+        try:
+            return self.run_query(submitted_parameters, use_cache)
+        except QueryTimeout, e:
+            self.timed_out = e.timeout
+            return [], []
+
+    def clean(self):
+        #Without a schedule snapshots would be refreshed on every check
+        if self.materialized and self.snapshot_refresh_time is None:
+            raise ValidationError("Please choose a snapshot refresh time for materialized data sets.")
+
     def edit_link(self):
         return mark_safe("<a href='/admin/mr_reports/dataset/%s/'>Edit</a>" % self.id)
 
@@ -203,6 +632,47 @@ class Style(AuditableTable):
         return self.name
 
 
+def run_in_parallel(calls, max_workers):
+    """Run a list of (function, args) in a bounded pool of threads and return their
+    results in the same order.
+
+    If any call raises, no new calls are started, the ones already running are
+    waited for, and the first error is re-raised."""
+    results = [None] * len(calls)
+    pending = Queue.Queue()
+    for i, call in enumerate(calls):
+        pending.put((i, call))
+    errors = []
+
+    def worker():
+        try:
+            while not errors:
+                try:
+                    i, (func, args) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(*args)
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            #Threads get their own Django DB connections, don't leave them open
+            for conn in db.connections.all():
+                conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max(max_workers, 1), len(calls)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        #join with a timeout so the main thread can still handle signals
+        while t.is_alive():
+            t.join(1)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
 class Report(AuditableTable):
     """This is an actual report, made up for one or more datasets."""
     title = models.CharField(max_length=200)
@@ -224,33 +694,118 @@ class Report(AuditableTable):
                                       choices=totwotuple(('Portrait','Landscape')),
                                       default='Portrait')
 
+    run_datasets_in_parallel = models.BooleanField(default=False,
+        help_text="Run this report's queries at the same time instead of one after another. "
+        "Useful when a report has several slow datasets, especially on different databases.")
+    max_parallel_queries = models.PositiveIntegerField(default=4,
+        help_text="When running in parallel, the most queries to run at once.")
+    run_in_background = models.BooleanField(default=False,
+        help_text="Run this report with the run_report_jobs command instead of while the user waits, "
+        "for reports that take too long to load. The user sees a page that updates when it's done.")
+
     #Files such as images that will be available for JS code to optionally use (coming soon!)
     #files_available = ...
 
+    #Set by set_prefetched for compiled reports (see plans.py)
+    _prefetched_datasets = None
+    _prefetched_parameters = None
+
+    def set_prefetched(self, datasets, parameters):
+        """Hold on to the results of get_datasets and get_parameters so they don't
+        query the database again"""
+        self._prefetched_datasets = datasets
+        self._prefetched_parameters = parameters
+
+    def get_datasets(self):
+        """This report's datasets in display order, with their connections loaded"""
+        if self._prefetched_datasets is not None:
+            #copies, since running a dataset stores state on it
+            return [copy.copy(dataset) for dataset in self._prefetched_datasets]
+        return [reportdataset.dataset for reportdataset in
+            self.reportdataset_set.select_related('dataset__connection').order_by('order_on_report')]
+
+    def get_parameters(self):
+        """All parameters used by this report's datasets, without duplicates, in the
+        order they should appear on the form (by order_on_report, then order_on_form).
+
+        Uses two queries no matter how many datasets and parameters there are."""
+        if self._prefetched_parameters is not None:
+            return list(self._prefetched_parameters)
+        order_on_report = {}
+        for dataset_id, order in self.reportdataset_set.values_list('dataset_id', 'order_on_report'):
+            order_on_report[dataset_id] = min(order, order_on_report.get(dataset_id, order))
+        all_parameters = DataSetParameter.objects.filter(dataset__in=order_on_report.keys()) \
+            .select_related('parameter').order_by('order_on_form', 'pk')
+        all_parameters = sorted(all_parameters,
+            key=lambda dp: (order_on_report[dp.dataset_id], dp.order_on_form))
+
+        #remove duplicates whilst preserving order
+        unique_parameters = []
+        for dp in all_parameters:
+            if dp.parameter not in unique_parameters:
+                unique_parameters.append(dp.parameter)
+        return unique_parameters
+
     def update_submitted_parameters_w_defaults(self, submitted_parameters):
         """If a user submits a form leaving a field with a default value blank, we want 
         to fill it in with a default value.
         (since the parameter form on the report is built dynamically it's better to do this here.)
         """
         if submitted_parameters:
+            if self._prefetched_parameters is not None:
+                parameters = dict((p.name, p) for p in self._prefetched_parameters)
+            else:
+                parameters = dict((p.name, p) for p in
+                    Parameter.objects.filter(name__in=submitted_parameters.cleaned_data.keys()))
             for pname, value in submitted_parameters.cleaned_data.items():
-                p = Parameter.objects.get(name=pname)
+                p = parameters[pname]
                 if not value and p.python_create_default:
                     submitted_parameters.cleaned_data[pname] = p.create_default()
         return submitted_parameters
 
-    def get_all_data(self, submitted_parameters=None):
+    def get_all_data(self, submitted_parameters=None, use_cache=True, table_state=None, paginate=True,
+            export_csv=False):
+        """Run every dataset's query and return a list of (dataset, data, columns).
+
+        table_state (such as request.GET) holds which page and sort order to show for
+        each dataset.  Set paginate to False to pull every row (for exports), and
+        export_csv to use the CSV row limits."""
         submitted_parameters = self.update_submitted_parameters_w_defaults(submitted_parameters)
 
         #Run queries to get datasets
+        all_datasets = self.get_datasets()
+        for dataset in all_datasets:
+            dataset.set_table_state(table_state or {}, paginate)
+            dataset.export_csv = export_csv
+        if self.run_datasets_in_parallel and len(all_datasets) > 1:
+            results = run_in_parallel([(dataset.run_for_report, (submitted_parameters, use_cache))
+                for dataset in all_datasets], self.max_parallel_queries)
+        else:
+            results = [dataset.run_for_report(submitted_parameters, use_cache) for dataset in all_datasets]
+
         datasets = []
-        for reportdataset in self.reportdataset_set.all().order_by('order_on_report'):
-            dataset = reportdataset.dataset
-            data, columns = dataset.run_query(submitted_parameters)
+        for dataset, (data, columns) in zip(all_datasets, results):
             columns = [col.replace('_',' ').title() for col in columns]
             datasets.append((dataset,data,columns))
         return datasets
 
+    def iter_all_data(self, submitted_parameters=None, use_cache=True, table_state=None):
+        """Like get_all_data, but yields (dataset, rows, columns) one dataset at a time
+        with rows as an iterator (see DataSet.iter_query).  Each query only runs
+        when its dataset is reached, so consume each rows iterator before moving on.
+        Rows are sorted per table_state but never paginated."""
+        submitted_parameters = self.update_submitted_parameters_w_defaults(submitted_parameters)
+        for dataset in self.get_datasets():
+            dataset.set_table_state(table_state or {}, paginate=False)
+            dataset.timed_out = None
+            try:
+                rows, columns = dataset.iter_query(submitted_parameters, use_cache)
+            except QueryTimeout, e:
+                dataset.timed_out = e.timeout
+                rows, columns = iter([]), []
+            columns = [col.replace('_',' ').title() for col in columns]
+            yield dataset, rows, columns
+
     def get_absolute_url(self):
         return reverse('mr_reports.views.report', args=[str(self.id)])
 
@@ -274,6 +829,16 @@ class ReportDataSet(models.Model):
     order_on_report = models.IntegerField(default=0, help_text="Enter a number greater than or equal to 0 to specify "
         "which order this dataset should be displayed on the report. Lower numbers come first")
 
+def make_aware_local(value):
+    """timezone.make_aware in the default time zone for local times that may fall in a
+    daylight saving change: times skipped by the change come out an hour later, and
+    times that happen twice are taken as the second (standard time) one"""
+    tz = timezone.get_default_timezone()
+    if hasattr(tz, 'localize'):
+        #pytz
+        return tz.normalize(tz.localize(value, is_dst=False))
+    return timezone.make_aware(value, tz)
+
 class Subscription(models.Model):
     """Controls who gets emailed which reports when."""
     class Meta:
@@ -291,43 +856,128 @@ class Subscription(models.Model):
         "from the start_date and time.)")
     frequency = models.CharField(max_length=20,
       choices=totwotuple(('Daily','Weekly','Monthly','Yearly')), default='Monthly')
+    deliver_by = models.TimeField(null=True, blank=True,
+        help_text="Optional. The report only needs to arrive by this time of day, so it may be "
+        "sent any time between 'time' and this. Lets reports that share a time be spread out "
+        "instead of all hitting the databases at once. Example input: 7:00")
     email_subject = models.CharField(max_length=200, blank=True)
     email_body_extra = models.TextField(blank=True)
     last_scheduled_run = models.DateTimeField(null=True, editable=False)
     last_run_succeeded = models.BooleanField(default=False, editable=False)
 
+    next_run_at = models.DateTimeField(null=True, editable=False, db_index=True,
+        help_text="When this subscription is next due to be sent. Kept up to date when it's saved.")
+    lease_owner = models.CharField(max_length=200, blank=True, editable=False,
+        help_text="The runner currently sending this subscription, if any")
+    lease_expires_at = models.DateTimeField(null=True, editable=False,
+        help_text="When the current runner's claim on this subscription runs out, "
+        "after which another runner may take it over.")
+    average_run_seconds = models.FloatField(null=True, editable=False,
+        help_text="How long this subscription usually takes to send (a moving average)")
+
+    def delivery_deadline(self):
+        """When the next run needs to be delivered by, or None if there's no delivery window"""
+        if self.deliver_by is None or self.next_run_at is None:
+            return None
+        tz = timezone.get_default_timezone()
+        start = timezone.make_naive(self.next_run_at, tz)
+        #the window is on the day the run is due, whenever that day it actually starts
+        deadline = datetime.datetime.combine(start.date(), self.deliver_by)
+        if self.deliver_by <= self.time:
+            #window runs past midnight
+            deadline += datetime.timedelta(days=1)
+        return make_aware_local(deadline)
+
+    def record_run_seconds(self, seconds):
+        if self.average_run_seconds is None:
+            self.average_run_seconds = seconds
+        else:
+            self.average_run_seconds = 0.7 * self.average_run_seconds + 0.3 * seconds
+
+    def next_occurrence(self, now=None):
+        """Return the earliest time this subscription is due to be sent after its last run.
+
+        A subscription is due at or after 'time' of day, on or after the start_date, once:
+          Daily: 24 hours have passed since the last run
+          Weekly: 7 days have passed since the last run
+          Monthly: it's the start_date's day of the month (and it hasn't run that day already), 
+            or more than 31 days have passed since the last run
+          Yearly: it's the start_date's month and day (and it hasn't run that day already), 
+            or 366 days have passed since the last run
+
+        If 'now' is given, runs after it are ignored (useful for testing with other dates).
+        """
+        tz = timezone.get_default_timezone()
+        last_run = None
+        if self.last_scheduled_run and (now is None or self.last_scheduled_run <= now):
+            last_run = timezone.make_naive(self.last_scheduled_run, tz)
+        return self._occurrence_after(last_run)
+
+    def _occurrence_after(self, last_run):
+        """next_occurrence after a run at last_run (a naive local time, or None)"""
+        first = datetime.datetime.combine(self.start_date, self.time)
+        def due_from(value):
+            #earliest time at or after value that's on or after the first run and past the time of day
+            value = max(value, first)
+            if value.time() < self.time:
+                value = datetime.datetime.combine(value.date(), self.time)
+            return value
+
+        if last_run is None:
+            occurrence = first
+        elif self.frequency == 'Daily':
+            occurrence = due_from(last_run + datetime.timedelta(days=1))
+        elif self.frequency == 'Weekly':
+            occurrence = due_from(last_run + datetime.timedelta(days=7))
+        else:
+            if self.frequency == 'Monthly':
+                occurrence = due_from(last_run + datetime.timedelta(days=31, microseconds=1))
+                months = 1
+            else:
+                occurrence = due_from(last_run + datetime.timedelta(days=366))
+                months = 12
+            #Look for the next matching day after the last run (skipping short months)
+            day = max(first.date(), last_run.date() + datetime.timedelta(days=1))
+            step = 0
+            candidate = self.start_date
+            while candidate < day or candidate.day != self.start_date.day:
+                step += months
+                candidate = self.start_date + relativedelta(months=step)
+            occurrence = min(occurrence, due_from(datetime.datetime.combine(candidate, self.time)))
+
+        return make_aware_local(occurrence)
+
+    def current_occurrence(self, today=None):
+        """The latest time this subscription was due, at or before now (or 'today').  A run
+        counts as this occurrence however late it starts or long it takes, so is stored as
+        last_scheduled_run, and later runs stay on schedule.  After runs have been missed
+        (for instance while the scheduler was down) only the latest is made up."""
+        if today:
+            tt = make_aware_local(today)
+        else:
+            tt = timezone.localtime(timezone.now())
+        tz = timezone.get_default_timezone()
+        occurrence = self.next_occurrence(now=tt)
+        while True:
+            following = self._occurrence_after(timezone.make_naive(occurrence, tz))
+            if following > tt:
+                return occurrence
+            occurrence = following
+
     def should_send(self, today=None):
         """Determines whether this schedule should fire at the current time
 
         (today defaults to current day, but you can set different dates for testing.)
         """
         if today:
-            tt = timezone.make_aware(today, timezone.get_default_timezone())
+            tt = make_aware_local(today)
         else:
             tt = timezone.localtime(timezone.now())
-        t = tt.date()
-
-        last_run = self.last_scheduled_run or datetime.datetime.min.replace(tzinfo=timezone.utc)
-        time_since_last_run = tt - last_run
+        return self.next_occurrence(now=tt) <= tt
 
-        seconds_since_last_run = time_since_last_run.seconds + (time_since_last_run.days * 24 * 3600)
-
-        hours_since_last_run = seconds_since_last_run / 3600.0
-        days_since_last_run = seconds_since_last_run / (3600.0 * 24)
-
-        if tt.time() >= self.time and t >= self.start_date:
-
-            if self.frequency == 'Daily' and hours_since_last_run >= 24:
-                return True
-            elif self.frequency == 'Weekly' and days_since_last_run >= 7:
-                return True
-            elif (self.frequency == 'Monthly') and ((self.start_date.day == t.day) or (days_since_last_run > 31)):
-                return True
-            elif (self.frequency == 'Yearly') and ((t.month == self.start_date.month and t.day == self.start_date.day) \
-                or (days_since_last_run >= 366)):
-                return True
-
-        return False
+    def save(self, *args, **kwargs):
+        self.next_run_at = self.next_occurrence()
+        super(Subscription, self).save(*args, **kwargs)
 
     def clean(self):
         # I didn't have a clever way to handle monthly/yearly schedules when starting
@@ -338,3 +988,248 @@ class Subscription(models.Model):
     def __unicode__(self):
         return "Send %s to %s %s" % (self.report, self.send_to, self.frequency)
 
+class SchedulerHeartbeat(models.Model):
+    """Kept up to date by each 'send_scheduled_reports --daemon' process, so a scheduler
+    that has died or stalled can be noticed by an old last_beat."""
+    name = models.CharField(max_length=200, unique=True, help_text="host:process id")
+    started_at = models.DateTimeField()
+    last_beat = models.DateTimeField()
+    running = models.BooleanField(default=True, help_text="False once the scheduler has shut down cleanly")
+
+    def __unicode__(self):
+        return self.name
+
+class SnapshotParameters(object):
+    """Stands in for the parameter form when refreshing a snapshot, which only needs
+    its cleaned_data"""
+    def __init__(self, cleaned_data):
+        self.cleaned_data = cleaned_data
+
+class DataSetSnapshot(models.Model):
+    """Stored results of a materialized DataSet for one set of parameters"""
+    class Meta:
+        unique_together = (('dataset', 'key'),)
+    dataset = models.ForeignKey(DataSet)
+    key = models.CharField(max_length=40, help_text="Hash of the parameters, see DataSet.snapshot_key")
+    #pickled cleaned_data of the parameters, to re-run with
+    parameters = models.BinaryField()
+    #pickled (data, columns), None if a snapshot couldn't be taken yet
+    result = models.BinaryField(null=True)
+    truncated_at = models.PositiveIntegerField(null=True, blank=True)
+    refreshed_at = models.DateTimeField(null=True)
+    last_used_at = models.DateTimeField(null=True, db_index=True,
+        help_text="When the snapshot was last shown on a report (to the hour)")
+    refresh_failed_at = models.DateTimeField(null=True,
+        help_text="When refreshing the snapshot last failed. It's tried again at the next refresh time.")
+
+    def get_result(self):
+        return cPickle.loads(str(self.result))
+
+    def mark_used(self):
+        now = timezone.now()
+        #at most once an hour, rather than a write on every page view
+        if self.last_used_at is None or self.last_used_at < now - datetime.timedelta(hours=1):
+            self.last_used_at = now
+            DataSetSnapshot.objects.filter(pk=self.pk).update(last_used_at=now)
+
+    def is_due(self, now=None):
+        """Whether it's time to refresh this snapshot"""
+        now = now or timezone.now()
+        #after a failure, wait for the next refresh time (or a change to the data set)
+        last_tried = max(t for t in (self.refreshed_at, self.refresh_failed_at) if t)
+        if last_tried < self.dataset.updated_datetime:
+            return True
+        refresh_time = self.dataset.snapshot_refresh_time
+        if refresh_time is None:
+            #no schedule (see DataSet.clean), only refreshed when the data set is saved
+            return False
+        return last_tried < last_time_of_day(refresh_time, now)
+
+    def refresh(self):
+        dataset = copy.copy(self.dataset)
+        parameters = cPickle.loads(str(self.parameters))
+        dataset.take_snapshot(SnapshotParameters(parameters) if parameters is not None else None, used=False)
+
+    @classmethod
+    def purge_unused(cls, now=None):
+        """Delete snapshots for parameters that haven't been used in
+        MR_REPORTS_SNAPSHOT_RETENTION_DAYS, so each new set of parameters (such as a
+        date defaulting to today) isn't refreshed forever.  Data sets without
+        parameters keep their one snapshot.  Returns how many were deleted."""
+        now = now or timezone.now()
+        cutoff = now - datetime.timedelta(days=getattr(settings, 'MR_REPORTS_SNAPSHOT_RETENTION_DAYS', 7))
+        unused = cls.objects.filter(last_used_at__lt=cutoff, dataset__datasetparameter__isnull=False) \
+            .values_list('pk', flat=True).distinct()
+        pks = list(unused)
+        cls.objects.filter(pk__in=pks).delete()
+        return len(pks)
+
+    @classmethod
+    def record_failure(cls, dataset, key, parameters):
+        """Note that a snapshot couldn't be taken, so it isn't tried again until the next
+        refresh time.  parameters is pickled, as stored."""
+        now = timezone.now()
+        try:
+            with db.transaction.atomic():
+                if not cls.objects.filter(dataset=dataset, key=key).update(refresh_failed_at=now):
+                    #nothing to show yet, see DataSet.run_snapshot
+                    cls.objects.create(dataset=dataset, key=key, parameters=parameters,
+                        refresh_failed_at=now, last_used_at=now)
+        except db.IntegrityError:
+            #another process just stored it
+            pass
+
+    @classmethod
+    def refresh_due(cls, now=None):
+        """Refresh the snapshots of materialized datasets that are due, and take a first
+        snapshot of materialized datasets without parameters.  Returns how many were taken.
+
+        A snapshot that fails is logged and skipped, and not tried again until its next
+        refresh time."""
+        cls.purge_unused(now)
+        count = 0
+        for dataset in DataSet.objects.filter(materialized=True, datasetsnapshot__isnull=True,
+                datasetparameter__isnull=True).select_related('connection'):
+            try:
+                dataset.take_snapshot(None, used=False)
+                count += 1
+            except Exception:
+                logger.exception("Couldn't take a snapshot of data set %s", dataset)
+                cls.record_failure(dataset, dataset.snapshot_key(None),
+                    cPickle.dumps(None, cPickle.HIGHEST_PROTOCOL))
+        for snapshot in cls.objects.filter(dataset__materialized=True).select_related('dataset__connection') \
+                .defer('result'):
+            if snapshot.is_due(now):
+                try:
+                    snapshot.refresh()
+                    count += 1
+                except Exception:
+                    logger.exception("Couldn't refresh a snapshot of data set %s", snapshot.dataset)
+                    cls.record_failure(snapshot.dataset, snapshot.key, snapshot.parameters)
+        return count
+
+def last_time_of_day(time_of_day, now):
+    """The most recent time it was time_of_day (local time) as of now"""
+    tz = timezone.get_default_timezone()
+    local_now = timezone.make_naive(now, tz)
+    last = datetime.datetime.combine(local_now.date(), time_of_day)
+    if last > local_now:
+        last -= datetime.timedelta(days=1)
+    return make_aware_local(last)
+
+class ReportJob(models.Model):
+    """A run of a report in the background (see Report.run_in_background) and its results.
+    Jobs are run by the run_report_jobs management command."""
+    class Meta:
+        ordering = ['-created_at']
+    report = models.ForeignKey(Report)
+    user = models.ForeignKey(User, null=True, blank=True)
+    parameters = models.TextField(blank=True, help_text="The report's query string")
+    format = models.CharField(max_length=10, blank=True, help_text="Blank for web page, csv or pdf")
+    status = models.CharField(max_length=20, db_index=True, default='Queued',
+        choices=totwotuple(('Queued','Running','Done','Failed')))
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=200, blank=True, help_text="host:process id of the runner")
+    error = models.TextField(blank=True)
+    #pickled list of (dataset id, dataset state, data, columns)
+    result = models.BinaryField(null=True, editable=False)
+
+    #Dataset attributes set while running that are needed to display it
+    RESULT_STATE = ('cached_at', 'page', 'sort', 'has_next_page', 'truncated_at', 'timed_out',
+        'snapshot_at')
+
+    @classmethod
+    def claim_next(cls, worker):
+        """Mark the oldest queued job as running by worker and return it, or None if
+        there aren't any.  Jobs left running past MR_REPORTS_JOB_TIMEOUT_SECONDS (for
+        example because their runner died) are marked failed."""
+        now = timezone.now()
+        stale = now - datetime.timedelta(seconds=getattr(settings, 'MR_REPORTS_JOB_TIMEOUT_SECONDS', 3600))
+        cls.objects.filter(status='Running', started_at__lt=stale).update(status='Failed',
+            finished_at=now, error="Job did not finish in time")
+        for job_id in cls.objects.filter(status='Queued').order_by('created_at', 'pk') \
+                .values_list('pk', flat=True)[:10]:
+            #only one runner's update can match
+            if cls.objects.filter(pk=job_id, status='Queued').update(status='Running',
+                    worker=worker, started_at=now):
+                return cls.objects.get(pk=job_id)
+        return None
+
+    @classmethod
+    def purge_old(cls, now=None):
+        """Delete finished jobs (and their stored results) older than
+        MR_REPORTS_JOB_RETENTION_DAYS.  Returns how many were deleted."""
+        now = now or timezone.now()
+        cutoff = now - datetime.timedelta(days=getattr(settings, 'MR_REPORTS_JOB_RETENTION_DAYS', 7))
+        old_jobs = cls.objects.filter(status__in=('Done', 'Failed'), finished_at__lt=cutoff)
+        count = old_jobs.count()
+        old_jobs.delete()
+        return count
+
+    def run(self):
+        """Run the report and store its results"""
+        report, ParameterForm = plans.get_report_plan(self.report_id)
+        table_state = QueryDict(self.parameters)
+        parameter_form = None
+        if ParameterForm:
+            parameter_form = ParameterForm(table_state)
+            if not parameter_form.is_valid():
+                raise ValueError("Invalid parameters: %s" % parameter_form.errors)
+        #refresh is only kept for staff, see views.start_report_job.  Results are kept up to
+        #the CSV row limits so the finished report's CSV link has them all, see get_all_data
+        datasets = report.get_all_data(parameter_form, use_cache=not table_state.get('refresh'),
+            table_state=table_state, paginate=False, export_csv=True)
+        result = []
+        for dataset, data, columns in datasets:
+            if not isinstance(data, ResultSet):
+                data = [tuple(row) for row in data]
+            state = dict((name, getattr(dataset, name)) for name in self.RESULT_STATE)
+            result.append((dataset.pk, state, data, columns))
+        self.result = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        self.status = 'Done'
+        self.finished_at = timezone.now()
+        self.save()
+
+    def get_all_data(self, export_csv=False):
+        """The stored results, in the same form as Report.get_all_data.  They're cut down
+        to the web row limits unless export_csv is set."""
+        stored = cPickle.loads(str(self.result))
+        by_pk = dict((d.pk, d) for d in DataSet.objects.filter(
+            pk__in=[pk for pk, state, data, columns in stored]).select_related('connection'))
+        datasets = []
+        for pk, state, data, columns in stored:
+            if pk not in by_pk:
+                #deleted since the job ran
+                continue
+            dataset = copy.copy(by_pk[pk])
+            for name, value in state.items():
+                setattr(dataset, name, value)
+            #The results are fixed, so there's no re-sorting them
+            dataset.sortable = False
+            dataset.export_csv = export_csv
+            max_rows = dataset.row_limits()[0]
+            if max_rows and len(data) > max_rows:
+                data = data[:max_rows]
+                dataset.truncated_at = max_rows
+            datasets.append((dataset, data, columns))
+        return datasets
+
+    def get_absolute_url(self):
+        return reverse('mr_reports.views.job_status', args=[str(self.report_id), str(self.id)])
+
+    def result_url(self):
+        """The finished report, in the format it was asked for"""
+        query = QueryDict(self.parameters, mutable=True)
+        query.pop('refresh', None)
+        query['job'] = str(self.id)
+        url = self.report.get_absolute_url()
+        if self.format:
+            url += self.format + '/'
+        return url + '?' + query.urlencode()
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.report, self.status)
+
+import plans #registers signal handlers that keep compiled reports up to date
@@ -0,0 +1,246 @@
+"""
+PDF output helpers.
+
+PDFs are made by a backend (by default a wkhtmltopdf subprocess per render, see
+PDFBackend to plug in something else) behind a RenderPool, which limits how many
+renders run at once, makes a limited number of callers wait their turn, turns the
+rest away, and gives up on renders that take too long.
+
+Generated PDFs are cached on local disk under a hash of everything that goes into
+them (the report HTML, and the wkhtmltopdf options such as paper size and
+orientation), so identical reports aren't rendered twice.  The cache is kept under
+MR_REPORTS_PDF_CACHE_MAX_MB by removing the least recently used files.
+"""
+import hashlib
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+
+class PDFRenderError(Exception):
+    """A PDF couldn't be made"""
+    pass
+
+class PDFRenderTimeout(PDFRenderError):
+    """A render ran over its time limit and was stopped"""
+    pass
+
+class PDFRenderBusy(PDFRenderError):
+    """Too many renders are already running or waiting"""
+    pass
+
+
+class PDFBackend(object):
+    """Interface for turning HTML into a PDF.
+
+    Subclass this and point MR_REPORTS_PDF_BACKEND at it to use another renderer,
+    for example a long-lived browser process.  Backends are shared by every
+    thread in the process, so render() must be thread safe."""
+    def render(self, html, options, timeout):
+        """Return the PDF for html (utf8 encoded bytes).  options is a list of
+        wkhtmltopdf style options (--page-size, --orientation, etc.).  Should raise
+        PDFRenderTimeout if it takes more than timeout seconds and PDFRenderError
+        for other failures."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release anything the backend holds on to (processes, connections)"""
+        pass
+
+
+class SubprocessBackend(PDFBackend):
+    """Runs wkhtmltopdf once per render"""
+    def __init__(self, path=None, options=None):
+        self.path = path or getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_PATH', '')
+        self.options = list(options if options is not None
+            else getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_OPTIONS', []))
+
+    def render(self, html, options, timeout):
+        command = [self.path] + self.options + list(options)
+        command += ["-","-"] #"-" to tell WKHTMLTOPDF to use pipes for input and output
+        #Own process group so a kill also takes out anything wkhtmltopdf started
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            pdf, errors = process.communicate(html)
+        finally:
+            timer.cancel()
+            if process.returncode is None:
+                kill()
+                process.wait()
+        if timed_out:
+            raise PDFRenderTimeout("PDF took longer than %s seconds to generate" % timeout)
+        if process.returncode != 0 or not pdf:
+            raise PDFRenderError("wkhtmltopdf failed (exit code %s): %s" % (process.returncode, errors))
+        return pdf
+
+
+class RenderPool(object):
+    """Runs at most max_renders renders at once.  Up to max_queued more callers wait
+    (for at most queue_timeout seconds) for a turn, and the rest get PDFRenderBusy
+    straight away rather than piling up."""
+    def __init__(self, backend, max_renders=2, max_queued=10, queue_timeout=30, timeout=120):
+        self.backend = backend
+        self.max_renders = max_renders
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def _acquire(self):
+        with self.condition:
+            if self.running < self.max_renders:
+                self.running += 1
+                return
+            if self.waiting >= self.max_queued:
+                raise PDFRenderBusy("Too many PDFs are being generated, please try again later")
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.queue_timeout
+                while self.running >= self.max_renders:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PDFRenderBusy("Timed out waiting to generate PDF, please try again later")
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+
+    def _release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+    def render(self, html, options, timeout=None):
+        self._acquire()
+        try:
+            return self.backend.render(html, options, timeout or self.timeout)
+        finally:
+            self._release()
+
+    def close(self):
+        self.backend.close()
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_renderer():
+    """The process-wide RenderPool, created on first use from the MR_REPORTS_PDF_* settings"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            backend_class = import_by_path(getattr(settings, 'MR_REPORTS_PDF_BACKEND',
+                'mr_reports.pdf.SubprocessBackend'))
+            _renderer = RenderPool(backend_class(),
+                max_renders=getattr(settings, 'MR_REPORTS_PDF_MAX_RENDERS', 2),
+                max_queued=getattr(settings, 'MR_REPORTS_PDF_MAX_QUEUED', 10),
+                queue_timeout=getattr(settings, 'MR_REPORTS_PDF_QUEUE_TIMEOUT', 30),
+                timeout=getattr(settings, 'MR_REPORTS_PDF_TIMEOUT', 120))
+        return _renderer
+
+def close_renderer():
+    global _renderer
+    with _renderer_lock:
+        renderer, _renderer = _renderer, None
+    if renderer:
+        renderer.close()
+
+
+#Shared by every PDFCache so threads don't evict at the same time
+_evict_lock = threading.Lock()
+
+class PDFCache(object):
+    """Size-bounded LRU cache of PDFs in a directory.  Each file's modification time
+    is its last use."""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, html, options):
+        sha = hashlib.sha256()
+        for option in options:
+            sha.update(option.encode('utf8') if isinstance(option, unicode) else option)
+            sha.update('\0')
+        sha.update(html)
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            #mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError:
+                #another process may have just made it
+                if not os.path.isdir(self.directory):
+                    raise
+        #write to a temporary file first so readers never see a partial PDF
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used PDFs until the cache fits in max_bytes"""
+        with _evict_lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.pdf'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+def get_pdf_cache():
+    """The PDF cache, or None if it's turned off (MR_REPORTS_PDF_CACHE_MAX_MB = 0)"""
+    max_mb = getattr(settings, 'MR_REPORTS_PDF_CACHE_MAX_MB', 100)
+    if not max_mb:
+        return None
+    directory = getattr(settings, 'MR_REPORTS_PDF_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'mr_reports_pdf_cache'))
+    return PDFCache(directory, max_mb * 1024 * 1024)
@@ -0,0 +1,89 @@
+"""
+In-process cache of compiled report definitions ("plans").
+
+Rendering a report needs the Report, its ordered datasets and their connections,
+the report's parameters, and a ParameterForm class built from them.  That only
+changes when someone edits it in the admin, so each process keeps a compiled copy
+per report.
+
+Saving or deleting any of the models a plan is built from bumps a version stamp
+kept in Django's cache (MR_REPORTS_CACHE).  Every process checks the stamp before
+using a plan, so use a cache shared between processes (such as memcached) if you
+run more than one.
+"""
+import copy
+import threading
+import time
+
+from django.core.cache import get_cache
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from models import Report, DataSet, ReportDataSet, DataSetParameter, Parameter, Style, \
+    DataConnection
+
+VERSION_KEY = 'mr_reports:plan_version'
+#Longest timeout memcached accepts (Django 1.6 has no "cache forever")
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# Report pk -> (version, ReportPlan)
+_plans = {}
+_lock = threading.Lock()
+
+
+def _get_cache():
+    return get_cache(getattr(settings, 'MR_REPORTS_CACHE', 'default'))
+
+def _new_version():
+    #Not reusing old numbers in case the stamp is evicted from the cache
+    return int(time.time() * 1000)
+
+def get_version():
+    cache = _get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), VERSION_TIMEOUT)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def invalidate(**kwargs):
+    """Throw out every compiled plan, in all processes.  (Used as a signal handler.)"""
+    cache = _get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, _new_version(), VERSION_TIMEOUT)
+    with _lock:
+        _plans.clear()
+
+for model in (Report, DataSet, ReportDataSet, DataSetParameter, Parameter, Style, DataConnection):
+    post_save.connect(invalidate, sender=model, dispatch_uid='mr_reports_plan_save_%s' % model.__name__)
+    post_delete.connect(invalidate, sender=model, dispatch_uid='mr_reports_plan_delete_%s' % model.__name__)
+
+
+class ReportPlan(object):
+    """Everything needed to run a report that comes from its definition"""
+    def __init__(self, report_id):
+        from views import build_parameter_form
+        report = Report.objects.select_related('style').get(pk=report_id)
+        report.set_prefetched(report.get_datasets(), report.get_parameters())
+        self.report = report
+        self.ParameterForm = build_parameter_form(report)
+
+
+def get_report_plan(report_id):
+    """Return (report, ParameterForm) for a report, compiling its plan if the cached
+    one is missing or out of date.  Raises Report.DoesNotExist.
+
+    The report is a copy, so it's fine to change it while rendering."""
+    report_id = int(report_id)
+    version = get_version()
+    with _lock:
+        cached = _plans.get(report_id)
+    if cached and cached[0] == version:
+        plan = cached[1]
+    else:
+        plan = ReportPlan(report_id)
+        with _lock:
+            _plans[report_id] = (version, plan)
+    return copy.copy(plan.report), plan.ParameterForm
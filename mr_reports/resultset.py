@@ -0,0 +1,157 @@
+"""
+Compact container for query results.
+
+A list of sqlalchemy rows costs an object (plus a tuple) per row.  ResultSet keeps
+every value in one flat tuple instead, and hands out lightweight row views on
+demand.  Slicing returns a view onto the same buffer, so pagination doesn't copy.
+
+It behaves like the list of rows it replaces: len(), iteration, indexing and
+slicing work, and each row can be iterated, indexed by position or by column
+name, and compared to a tuple.
+"""
+import sys
+
+
+def _approximate_size(row):
+    #each value plus the pointer to it
+    return sum(sys.getsizeof(value) for value in row) + 8 * len(row)
+
+
+class ResultSet(object):
+    __slots__ = ('columns', '_values', '_width', '_start', '_stop', '_index')
+
+    def __init__(self, columns, values, start=0, stop=None, index=None):
+        self.columns = columns
+        self._values = values
+        self._width = max(len(columns), 1)
+        self._start = start
+        self._stop = len(values) // self._width if stop is None else stop
+        if index is None:
+            index = dict((name, i) for i, name in enumerate(columns))
+        self._index = index
+
+    @classmethod
+    def from_result(cls, result, columns, batch_size=1000, max_rows=None, max_bytes=None):
+        """Build from a sqlalchemy result, fetching batch_size rows at a time.
+
+        Stops after max_rows rows, or once the values take up roughly max_bytes.
+        Returns (result set, whether it was truncated)."""
+        values = []
+        fetched, size = 0, 0
+        while True:
+            if max_rows is not None and fetched >= max_rows:
+                #only truncated if there was something left to fetch
+                return cls(columns, tuple(values)), result.fetchone() is not None
+            if max_bytes is not None and size >= max_bytes:
+                return cls(columns, tuple(values)), result.fetchone() is not None
+            if max_rows is not None:
+                batch = result.fetchmany(min(batch_size, max_rows - fetched))
+            else:
+                batch = result.fetchmany(batch_size)
+            if not batch:
+                return cls(columns, tuple(values)), False
+            for row in batch:
+                values.extend(row)
+                if max_bytes is not None:
+                    size += _approximate_size(row)
+            fetched += len(batch)
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        values = []
+        for row in rows:
+            values.extend(row)
+        return cls(columns, tuple(values))
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        for i in xrange(self._start, self._stop):
+            yield Row(self, i * self._width)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            return ResultSet(self.columns, self._values, self._start + start,
+                self._start + max(start, stop), self._index)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('ResultSet index out of range')
+        return Row(self, (self._start + key) * self._width)
+
+    def column(self, key):
+        """All of one column's values (by name or position) as a tuple"""
+        if not isinstance(key, (int, long)):
+            key = self._index[key]
+        start = self._start * self._width + key
+        return self._values[start:self._stop * self._width:self._width]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __reduce__(self):
+        #Only pickle the rows this view covers
+        return (ResultSet, (self.columns,
+            self._values[self._start * self._width:self._stop * self._width]))
+
+    def __repr__(self):
+        return 'ResultSet(%r)' % [tuple(row) for row in self]
+
+
+class Row(object):
+    """View of one row of a ResultSet"""
+    __slots__ = ('_result', '_offset')
+
+    def __init__(self, result, offset):
+        self._result = result
+        self._offset = offset
+
+    def __len__(self):
+        return self._result._width
+
+    def __iter__(self):
+        return iter(self._result._values[self._offset:self._offset + self._result._width])
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._result._index[key]
+        elif isinstance(key, slice):
+            return tuple(self)[key]
+        elif key < 0:
+            key += self._result._width
+        if not 0 <= key < self._result._width:
+            raise IndexError('Row index out of range')
+        return self._result._values[self._offset + key]
+
+    def keys(self):
+        return list(self._result.columns)
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return (tuple, (tuple(self),))
+
+    def __repr__(self):
+        return repr(tuple(self))
@@ -0,0 +1,128 @@
+"""
+Optionally run python_post_processing in a pool of separate worker processes
+instead of inside the web server process.
+
+Each worker has resource limits on memory (address space) and CPU time, so a
+runaway script can only take down its own worker, which is then replaced.  Workers
+are forked once and re-used across calls.  Turn this on with
+MR_REPORTS_SANDBOX_WORKERS (see README).
+
+Rows are sent to and from workers as pickled tuples, so scripts see 'data' as a
+list of tuples rather than sqlalchemy rows.
+
+Workers are forked (Python 2 has no other way to start them), and a fork copies
+only the thread doing it: a lock some other thread held at that moment stays locked
+in the worker forever.  Workers replace the locks they use when they start (see
+_reset_after_fork), but anything else they inherit can still be in that state, so
+start the pool with start_pool() while the process has only one thread, for
+example in wsgi.py.  (Workers replaced after MR_REPORTS_SANDBOX_TASKS_PER_WORKER
+scripts are forked from one of the pool's own threads.)
+"""
+import cPickle
+import multiprocessing
+import resource
+import threading
+import traceback
+
+from django.conf import settings
+
+from maybe_safe_eval import safe_eval as maybe_safe_eval, SafeEvalTimeoutException
+import columnar as columnar_module
+import engines
+import maybe_safe_eval as maybe_safe_eval_module
+
+#Extra time to wait for a worker beyond the script's own timeout
+GRACE_SECS = 5
+
+_pool = None
+_lock = threading.Lock()
+
+
+class SandboxError(Exception):
+    """Post processing failed in a sandbox worker"""
+    pass
+
+
+def _reset_after_fork():
+    """Replace locks the worker uses, in case another thread of the parent held them
+    when it forked"""
+    maybe_safe_eval_module.watchdog = maybe_safe_eval_module.Watchdog()
+    maybe_safe_eval_module.code_cache.lock = threading.Lock()
+    #The parent's pooled database connections aren't the worker's to use (or close)
+    engines._lock = threading.Lock()
+    engines._engines = {}
+
+def _init_worker(memory_mb):
+    _reset_after_fork()
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _set_cpu_limit(cpu_secs):
+    """CPU time is counted for the life of the process, so allow cpu_secs more
+    than this worker has used so far"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = int(usage.ru_utime + usage.ru_stime) + cpu_secs
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+def _post_process(code, packed_data, columns, cpu_secs, timeout_secs, use_columnar):
+    """Runs in the worker.  Exceptions don't always survive pickling, so errors
+    are sent back as text."""
+    try:
+        if cpu_secs:
+            _set_cpu_limit(cpu_secs)
+        data = cPickle.loads(packed_data)
+        if use_columnar:
+            data, columns = columnar_module.post_process(code, data, columns, timeout_secs)
+        else:
+            context = {'data': data}
+            maybe_safe_eval(code, context = context, timeout_secs = timeout_secs)
+            data = context['data']
+        return True, cPickle.dumps((data, columns), cPickle.HIGHEST_PROTOCOL)
+    except SafeEvalTimeoutException:
+        return False, None
+    except MemoryError:
+        return False, "Post processing ran out of memory"
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(getattr(settings, 'MR_REPORTS_SANDBOX_WORKERS', 2),
+                initializer=_init_worker,
+                initargs=(getattr(settings, 'MR_REPORTS_SANDBOX_MEMORY_MB', 512),),
+                maxtasksperchild=getattr(settings, 'MR_REPORTS_SANDBOX_TASKS_PER_WORKER', 100))
+        return _pool
+
+def start_pool():
+    """Start the workers now if MR_REPORTS_SANDBOX_WORKERS is set, rather than on first
+    use.  Call this before starting any threads, see above."""
+    if getattr(settings, 'MR_REPORTS_SANDBOX_WORKERS', 0):
+        get_pool()
+
+def post_process(code, data, columns, timeout_secs, columnar=False):
+    """Run post processing code on data in a sandbox worker and return the new
+    (data, columns).  Set columnar to use columnar.post_process.
+
+    Raises SafeEvalTimeoutException if the script runs out of time (or CPU), or
+    SandboxError for any other failure."""
+    packed_data = cPickle.dumps([tuple(row) for row in data], cPickle.HIGHEST_PROTOCOL)
+    cpu_secs = getattr(settings, 'MR_REPORTS_SANDBOX_CPU_SECS', timeout_secs)
+    result = get_pool().apply_async(_post_process, (code, packed_data, columns, cpu_secs, timeout_secs,
+        columnar))
+    try:
+        #A worker killed for going over its CPU limit never answers
+        ok, payload = result.get(timeout_secs + GRACE_SECS)
+    except multiprocessing.TimeoutError:
+        raise SafeEvalTimeoutException(timeout_secs)
+    if not ok:
+        if payload is None:
+            raise SafeEvalTimeoutException(timeout_secs)
+        raise SandboxError(payload)
+    return cPickle.loads(payload)
@@ -0,0 +1,58 @@
+"""
+Planning when due subscriptions start.
+
+Subscriptions without a delivery window (deliver_by) start as soon as they're due.
+Those with one are given a start time somewhere in their window: spread out so
+subscriptions sharing a time don't all start at once, but early enough to be done by
+deliver_by given how long they've taken before (average_run_seconds).  The spread is
+based on the subscription's id, so every check (and every runner) comes up with the
+same start times.
+
+Limits on how many subscriptions can use a DataConnection at once are checked when
+a subscription is claimed, see utils.claim_subscription.
+"""
+import datetime
+
+#Assumed run time for subscriptions that haven't run yet
+DEFAULT_RUN_SECONDS = 60
+#Plan on runs taking this many times longer than usual
+SAFETY_FACTOR = 2
+#Multiples of the golden ratio spread consecutive ids evenly across the window
+_SPREAD = 0.6180339887498949
+
+
+def latest_start(sched):
+    """Latest a subscription can start and still be delivered on time, or None
+    if it has no delivery window"""
+    deadline = sched.delivery_deadline()
+    if deadline is None:
+        return None
+    seconds = (sched.average_run_seconds or DEFAULT_RUN_SECONDS) * SAFETY_FACTOR
+    return max(deadline - datetime.timedelta(seconds=seconds), sched.next_run_at)
+
+def planned_start(sched):
+    latest = latest_start(sched)
+    if latest is None:
+        return sched.next_run_at
+    window = (latest - sched.next_run_at).total_seconds()
+    return sched.next_run_at + datetime.timedelta(seconds=window * ((sched.pk * _SPREAD) % 1))
+
+def urgency(sched):
+    """Sort key, most urgent first"""
+    return (latest_start(sched) or sched.next_run_at, sched.pk)
+
+def plan(groups, now):
+    """Given due subscriptions in groups that share a PDF, return the groups to start
+    now (most urgent first), and when the next of the rest should start (or None).
+
+    A whole group starts as soon as any of its subscriptions should, since the rest
+    can share its PDF without any more queries."""
+    start_now, next_start = [], None
+    for scheds in groups:
+        start = min(planned_start(sched) for sched in scheds)
+        if start <= now:
+            start_now.append(sorted(scheds, key=urgency))
+        elif next_start is None or start < next_start:
+            next_start = start
+    start_now.sort(key=lambda scheds: urgency(scheds[0]))
+    return start_now, next_start
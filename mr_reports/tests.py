@@ -3,17 +3,43 @@
 Some very basic tests.  More to come soon!
 """
 import os
+import pickle
+import shutil
+import signal
+import smtplib
 import sqlite3
+import tempfile
+import threading
+import time
 import datetime
 from dateutil.relativedelta import *
 
+from StringIO import StringIO
+
+from django.db import connection, connections, transaction
 from django.test import TestCase
+from django.core import mail
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 
 from mr_reports.models import Report, Parameter, DataSet, DataConnection, \
-    DataSetParameter, ReportDataSet, Subscription
-from mr_reports.utils import execute_subscription
+    DataSetParameter, ReportDataSet, Subscription, SchedulerHeartbeat, ReportJob, DataSetSnapshot, \
+    run_in_parallel, last_time_of_day
+from mr_reports.maybe_safe_eval import SafeEvalTimeoutException
+from mr_reports.utils import execute_subscription, claim_subscription, finish_subscription, send_email, \
+    lock_subscription, supports_skip_locked
+from mr_reports.management.commands.send_scheduled_reports import Command as SendScheduledReports
+from mr_reports.views import data_to_csv, build_parameter_form
+from mr_reports.plans import get_report_plan
+from mr_reports.resultset import ResultSet
+from mr_reports import scheduling
+from mr_reports.pdf import PDFCache, PDFBackend, SubprocessBackend, RenderPool, \
+    PDFRenderError, PDFRenderTimeout, PDFRenderBusy, close_renderer
 
 #Shortcuts
 t = datetime.time
@@ -23,6 +49,124 @@ nowish_w_dt = datetime.datetime.now().replace(tzinfo=timezone.get_default_timezo
 nowish = nowish_w_dt.time()
 dt_today = timezone.make_aware(dt.today(), timezone.get_default_timezone())
 
+class ResultSetTestCase(TestCase):
+    def test_rows_and_slices(self):
+        """Result sets act like a list of rows, and slices share the same buffer"""
+        data = ResultSet.from_rows(['a', 'b'], [(1, 'x'), (2, 'y'), (3, 'z')])
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data, [(1, 'x'), (2, 'y'), (3, 'z')])
+        self.assertEqual(data[-1]['b'], 'z')
+        page = data[1:]
+        self.assertEqual(page, [(2, 'y'), (3, 'z')])
+        self.assertIs(page._values, data._values)
+        self.assertEqual(page.column('a'), (2, 3))
+        self.assertEqual(pickle.loads(pickle.dumps(page)), [(2, 'y'), (3, 'z')])
+
+class PDFCacheTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lru_eviction(self):
+        """PDFs are found by content and the least recently used are removed first"""
+        cache = PDFCache(self.directory, 25)
+        keys = [cache.key('<html>%s</html>' % i, ['--page-size', 'Letter']) for i in range(3)]
+        self.assertNotEqual(cache.key('<html>0</html>', ['--page-size', 'A4']), keys[0])
+        cache.put(keys[0], 'a' * 10)
+        cache.put(keys[1], 'b' * 10)
+        #use the first one so the second is the oldest
+        os.utime(os.path.join(self.directory, keys[1] + '.pdf'), (0, 0))
+        self.assertEqual(cache.get(keys[0]), 'a' * 10)
+        cache.put(keys[2], 'c' * 10)
+        self.assertEqual(cache.get(keys[1]), None)
+        self.assertEqual(cache.get(keys[0]), 'a' * 10)
+        self.assertEqual(cache.get(keys[2]), 'c' * 10)
+
+class SlowBackend(PDFBackend):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def render(self, html, options, timeout):
+        self.release.wait(5)
+        return '%PDF ' + html
+
+class CountingPDFBackend(PDFBackend):
+    renders = 0
+
+    def render(self, html, options, timeout):
+        CountingPDFBackend.renders += 1
+        return '%PDF'
+
+class BrokenPDFBackend(PDFBackend):
+    renders = 0
+
+    def render(self, html, options, timeout):
+        BrokenPDFBackend.renders += 1
+        raise IOError("renderer crashed")
+
+class FlakyConnection(object):
+    """Stands in for smtplib.SMTP"""
+    dropped = False
+
+    def noop(self):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected()
+        return (250, 'OK')
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Drops the first connection after one message, and fails messages to 'refused@'"""
+    opened = 0
+    closed = 0
+    connection = None
+
+    def open(self):
+        if self.connection is None:
+            FlakyEmailBackend.opened += 1
+            self.connection = FlakyConnection()
+
+    def close(self):
+        if self.connection is not None:
+            FlakyEmailBackend.closed += 1
+        self.connection = None
+
+    def send_messages(self, messages):
+        if any(m.to == ['refused@example.com'] for m in messages):
+            raise smtplib.SMTPRecipientsRefused({'refused@example.com': (550, 'No such user')})
+        sent = super(FlakyEmailBackend, self).send_messages(messages)
+        if FlakyEmailBackend.opened == 1:
+            self.connection.dropped = True
+        return sent
+
+class RenderPoolTestCase(TestCase):
+    def test_backpressure(self):
+        """Renders beyond the pool size wait, and beyond the queue size are refused"""
+        backend = SlowBackend()
+        pool = RenderPool(backend, max_renders=1, max_queued=1, queue_timeout=5)
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(pool.render(str(i), [])))
+            for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while pool.running + pool.waiting < 2:
+            time.sleep(0.01)
+        self.assertRaises(PDFRenderBusy, pool.render, 'x', [])
+        backend.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['%PDF 0', '%PDF 1'])
+        self.assertEqual((pool.running, pool.waiting), (0, 0))
+
+    def test_subprocess_timeout(self):
+        """A render that hangs is killed"""
+        backend = SubprocessBackend(path='/bin/sh', options=[])
+        start = time.time()
+        self.assertRaises(PDFRenderTimeout, backend.render, '', ['-c', 'sleep 10'], 0.5)
+        self.assertTrue(time.time() - start < 5)
+        self.assertRaises(PDFRenderError, backend.render, '', ['-c', 'exit 1'], 5)
+        self.assertEqual(backend.render('', ['-c', 'echo %PDF'], 5), '%PDF\n')
+
 class ReportTestCase(TestCase):
     def setUp(self):
         #Create a simple database with test data for report to connect to
@@ -65,6 +209,639 @@ class ReportTestCase(TestCase):
         self.assertEqual(data, [(u'2006-01-05', u'BUY', u'RHAT', 100.0, 35.14)])
         self.assertEqual(columns, ['Date', 'Trans', 'Symbol', 'Qty', 'Price'])
 
+    def test_engine_reused(self):
+        """Each data connection keeps one pooled engine until it's saved"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        engine = connection.get_engine()
+        self.assertIs(DataConnection.objects.get(pk=connection.pk).get_engine(), engine)
+        connection.pool_recycle = 60
+        connection.save()
+        self.assertIsNot(connection.get_engine(), engine)
+
+    def test_parallel_datasets(self):
+        """Datasets run in parallel come back in report order"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        second = DataSet.objects.create(name='second', connection=connection, query="select symbol from stocks")
+        ReportDataSet.objects.create(report=self.report, dataset=second, order_on_report=1)
+        self.report.run_datasets_in_parallel = True
+        self.report.max_parallel_queries = 2
+        self.report.save()
+        datasets = self.report.get_all_data()
+        self.assertEqual([d[0].name for d in datasets], ['test', 'second'])
+        self.assertEqual(datasets[1][1], [(u'RHAT',)])
+
+    def test_parallel_datasets_error(self):
+        """A failing dataset raises its error when running in parallel"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        broken = DataSet.objects.create(name='broken', connection=connection, query="select * from nowhere")
+        ReportDataSet.objects.create(report=self.report, dataset=broken, order_on_report=1)
+        self.report.run_datasets_in_parallel = True
+        self.report.save()
+        self.assertRaises(Exception, self.report.get_all_data)
+
+    @override_settings(MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER=True,
+        MR_REPORTS_POST_PROCESSING_TIMEOUT=0.5)
+    def test_post_processing_timeout_in_parallel(self):
+        """Post processing that runs too long is stopped without disturbing other datasets
+        running in parallel (or what its thread runs next)"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        slow = DataSet(name='slow', connection=connection, query="select * from stocks",
+            python_post_processing="while 1: pass")
+        fast = DataSet(name='fast', connection=connection, query="select symbol from stocks",
+            python_post_processing="total = 0\nfor i in xrange(100000): total += i\ndata = data + [(total,)]")
+        results = []
+        def run(dataset):
+            try:
+                results.append((dataset.name, dataset.run_query(None)[0]))
+            except SafeEvalTimeoutException:
+                results.append((dataset.name, 'timed out'))
+        start = time.time()
+        run_in_parallel([(run, (slow,)), (run, (fast,)), (run, (fast,))], 2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(sorted(results), [('fast', [(u'RHAT',), (4999950000,)])] * 2 + [('slow', 'timed out')])
+        #nothing is left pending for this thread either
+        time.sleep(0.6)
+        self.assertEqual(fast.run_query(None)[0], [(u'RHAT',), (4999950000,)])
+
+    def test_cached_results(self):
+        """Cached datasets don't re-run the query until refreshed or saved"""
+        dataset = DataSet.objects.get(name='test')
+        dataset.cache_seconds = 60
+        dataset.save()
+        dataset.run_query(None)
+        conn = sqlite3.connect('sample_test.db')
+        conn.execute("DELETE FROM stocks")
+        conn.commit()
+        conn.close()
+        data, _ = dataset.run_query(None)
+        self.assertEqual(len(data), 1)
+        self.assertTrue(dataset.cached_at)
+        data, _ = dataset.run_query(None, use_cache=False)
+        self.assertEqual(data, [])
+        self.assertEqual(dataset.cached_at, None)
+
+    def test_streaming_csv(self):
+        """CSV export streams each dataset with a blank row between them"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        second = DataSet.objects.create(name='second', connection=connection, query="select symbol from stocks")
+        ReportDataSet.objects.create(report=self.report, dataset=second, order_on_report=1)
+        lines = list(data_to_csv(self.report.iter_all_data()))
+        self.assertEqual(lines, ['Date,Trans,Symbol,Qty,Price\r\n', '2006-01-05,BUY,RHAT,100.0,35.14\r\n',
+            '""\r\n', 'Symbol\r\n', 'RHAT\r\n'])
+
+    def test_pagination_and_sorting(self):
+        """Only the requested page is pulled, in the requested order"""
+        conn = sqlite3.connect('sample_test.db')
+        conn.execute("INSERT INTO stocks VALUES ('2006-01-06','SELL','IBM',50,80.5)")
+        conn.commit()
+        conn.close()
+        dataset = DataSet.objects.get(name='test')
+        dataset.page_size = 1
+        dataset.sortable = True
+        dataset.save()
+        dataset.set_table_state({dataset.page_param(): '1', dataset.sort_param(): '-4'})
+        data, _ = dataset.run_query(None)
+        self.assertEqual([row[2] for row in data], [u'RHAT'])
+        self.assertTrue(dataset.has_next_page)
+        dataset.set_table_state({dataset.page_param(): '2', dataset.sort_param(): '-4'})
+        data, _ = dataset.run_query(None)
+        self.assertEqual([row[2] for row in data], [u'IBM'])
+        self.assertFalse(dataset.has_next_page)
+        #exports get every row
+        dataset.set_table_state({dataset.page_param(): '2', dataset.sort_param(): '4'}, paginate=False)
+        data, _ = dataset.run_query(None)
+        self.assertEqual([row[2] for row in data], [u'IBM', u'RHAT'])
+
+    @override_settings(MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER=True)
+    def test_bad_sorting(self):
+        """Sorting past the last column is ignored, and post processed datasets aren't sorted"""
+        dataset = DataSet.objects.get(name='test')
+        dataset.sortable = True
+        dataset.set_table_state({dataset.sort_param(): '9'})
+        data, _ = dataset.run_query(None)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(dataset.sort, None)
+        #other errors aren't retried
+        broken = DataSet(name='broken', connection=dataset.connection, query="select * from nowhere",
+            sortable=True)
+        broken.set_table_state({broken.sort_param(): '1'})
+        self.assertRaises(Exception, broken.run_query, None)
+        self.assertEqual(broken.sort, 1)
+        dataset.python_post_processing = "data = [row[2:] for row in data]"
+        dataset.set_table_state({dataset.sort_param(): '1'})
+        self.assertEqual(dataset.sort, None)
+        self.assertFalse(dataset.can_sort())
+
+    def test_parameter_form_queries(self):
+        """Building the parameter form takes the same number of queries however many
+        datasets and parameters a report has"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        for i in range(3):
+            dataset = DataSet.objects.create(name='extra%s' % i, connection=connection, query="select 1")
+            ReportDataSet.objects.create(report=self.report, dataset=dataset, order_on_report=i + 1)
+            for j in range(2):
+                parameter = Parameter.objects.create(name='p%s_%s' % (i, j), data_type='CharField', required=False)
+                DataSetParameter.objects.create(dataset=dataset, parameter=parameter, order_on_form=1 - j)
+        with self.assertNumQueries(2):
+            ParameterForm = build_parameter_form(self.report)
+        form = ParameterForm({})
+        self.assertEqual(form.fields.keys(), ['test', 'p0_1', 'p0_0', 'p1_1', 'p1_0', 'p2_1', 'p2_0'])
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(1):
+            self.report.update_submitted_parameters_w_defaults(form)
+
+    def test_report_plan_cache(self):
+        """Compiled reports are re-used until something they're built from is saved"""
+        get_report_plan(self.report.id)
+        with self.assertNumQueries(0):
+            report, ParameterForm = get_report_plan(self.report.id)
+        self.assertEqual(ParameterForm().fields.keys(), ['test'])
+        Parameter.objects.create(name='another', data_type='CharField', required=False)
+        DataSetParameter.objects.create(dataset=DataSet.objects.get(name='test'),
+            parameter=Parameter.objects.get(name='another'), order_on_form=1)
+        report, ParameterForm = get_report_plan(self.report.id)
+        self.assertEqual(ParameterForm().fields.keys(), ['test', 'another'])
+
+    @override_settings(MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER=True, MR_REPORTS_SANDBOX_WORKERS=1)
+    def test_sandbox_post_processing(self):
+        """Post processing can run in a sandbox worker process"""
+        dataset = DataSet.objects.get(name='test')
+        dataset.python_post_processing = "data = [row[2:3] for row in data] + [('extra',)]"
+        data, _ = dataset.run_query(None)
+        self.assertEqual(data, [(u'RHAT',), ('extra',)])
+
+    @override_settings(MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER=True, MR_REPORTS_SANDBOX_WORKERS=1)
+    def test_sandbox_forked_with_lock_held(self):
+        """Sandbox workers forked while a lock they use is held still run scripts"""
+        from mr_reports import sandbox, maybe_safe_eval
+        if sandbox._pool is not None:
+            sandbox._pool.terminate()
+            sandbox._pool = None
+        with maybe_safe_eval.code_cache.lock:
+            sandbox.start_pool()
+        dataset = DataSet.objects.get(name='test')
+        dataset.python_post_processing = "data = [('ok',)]"
+        data, _ = dataset.run_query(None)
+        self.assertEqual(data, [('ok',)])
+
+    @override_settings(MR_REPORTS_ALLOW_NATIVE_PYTHON_CODE_EXEC_ON_SERVER=True)
+    def test_columnar_post_processing(self):
+        """Columnar post processing can add columns through 'table'"""
+        dataset = DataSet.objects.get(name='test')
+        dataset.columnar_post_processing = True
+        dataset.python_post_processing = "table['total'] = [q * p for q, p in zip(table['qty'], table['price'])]\n" \
+            "columns.remove('date')"
+        data, columns = dataset.run_query(None)
+        self.assertEqual(columns, ['trans', 'symbol', 'qty', 'price', 'total'])
+        self.assertEqual(data, [(u'BUY', u'RHAT', 100.0, 35.14, 3514.0)])
+        #changes made to 'data' in place are kept when 'table' is left alone
+        dataset.python_post_processing = "data.append(('2006-01-06', 'SELL', 'IBM', 50.0, 80.5))\n" \
+            "data.sort(key=lambda row: row[2])"
+        data, columns = dataset.run_query(None)
+        self.assertEqual([row[2] for row in data], [u'IBM', u'RHAT'])
+
+    def test_row_limits(self):
+        """Results past the row limit are cut off, with a separate limit for CSV"""
+        conn = sqlite3.connect('sample_test.db')
+        conn.executemany("INSERT INTO stocks VALUES ('2006-01-06','SELL','IBM',?,80.5)", [(i,) for i in range(5)])
+        conn.commit()
+        conn.close()
+        dataset = DataSet.objects.get(name='test')
+        dataset.max_rows = 2
+        dataset.csv_max_rows = 4
+        dataset.save()
+        data, _ = dataset.run_query(None)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(dataset.truncated_at, 2)
+        #the limit goes to the database too, so the rest are never read
+        self.assertEqual(dataset.build_query()[1], {'mr_reports_limit': 3})
+        lines = list(data_to_csv(self.report.iter_all_data()))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[-1], '(Results truncated at 4 rows)\r\n')
+        dataset.max_rows = 6
+        data, _ = dataset.run_query(None)
+        self.assertEqual(len(data), 6)
+        self.assertEqual(dataset.truncated_at, None)
+
+    def test_query_timeout(self):
+        """A query that runs past its timeout is cancelled and reported, without failing the report"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        connection.query_timeout_seconds = 1
+        connection.save()
+        slow = DataSet.objects.create(name='slow', connection=connection,
+            query="WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c")
+        ReportDataSet.objects.create(report=self.report, dataset=slow, order_on_report=1)
+        datasets = self.report.get_all_data()
+        self.assertEqual(datasets[0][1], [(u'2006-01-05', u'BUY', u'RHAT', 100.0, 35.14)])
+        self.assertEqual(datasets[1][0].timed_out, 1)
+        self.assertEqual(datasets[1][1], [])
+
+    def test_query_timeout_while_fetching(self):
+        """Queries cancelled after their first rows are reported as timeouts, and the
+        timeout only starts once the query runs"""
+        connection = DataConnection.objects.get(database='sample_test.db')
+        dataset = DataSet.objects.create(name='slow', connection=connection,
+            query="WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+            "SELECT x FROM c WHERE x = 1 OR x % 1000000000 = 0")
+        dataset.timeout_seconds = 0.3
+        self.assertEqual(dataset.run_for_report(None), ([], []))
+        self.assertEqual(dataset.timed_out, 0.3)
+        lines = list(data_to_csv([(dataset,) + dataset.iter_query(None)]))
+        self.assertEqual(lines[0], 'x\r\n')
+        self.assertEqual(lines[-1], '(Query cancelled after taking longer than 0.3 seconds)\r\n')
+        #waiting between checking out the connection and running the query doesn't count
+        dataset.query = "select * from stocks"
+        conn, close = dataset._connect()
+        try:
+            time.sleep(0.4)
+            self.assertEqual(len(dataset._execute(conn, None).fetchall()), 1)
+        finally:
+            close()
+
+    @override_settings(BASE_PATH='http://testserver', MR_REPORTS_WKHTMLTOPDF_PATH='wkhtmltopdf',
+        MR_REPORTS_PDF_BACKEND='mr_reports.tests.CountingPDFBackend', MR_REPORTS_PDF_CACHE_MAX_MB=0)
+    def test_shared_subscription_pdf(self):
+        """Subscriptions to the same report and parameters share one PDF"""
+        close_renderer()
+        CountingPDFBackend.renders = 0
+        other_user = User.objects.create_user('other', 'other@example.com', 'password')
+        for user, parameters in ((self.dummy_user, 'test=2014-03-21&use_defaults='),
+                (other_user, '?use_defaults=&test=2014-03-21')):
+            Subscription.objects.create(send_to=user, report=self.report, frequency='Daily',
+                email_subject='shared', time=nowish, start_date=d.today(),
+                report_parameters=parameters)
+        call_command('send_scheduled_reports', stdout=StringIO())
+        close_renderer()
+        self.assertEqual(CountingPDFBackend.renders, 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['dummy@example.com', 'other@example.com'])
+        self.assertTrue(all(s.last_run_succeeded for s in Subscription.objects.all()))
+
+    @override_settings(BASE_PATH='http://testserver', MR_REPORTS_WKHTMLTOPDF_PATH='wkhtmltopdf',
+        MR_REPORTS_PDF_BACKEND='mr_reports.tests.BrokenPDFBackend', MR_REPORTS_PDF_CACHE_MAX_MB=0)
+    def test_shared_subscription_pdf_failure(self):
+        """A PDF that fails to render fails the whole group without trying again for each one"""
+        close_renderer()
+        BrokenPDFBackend.renders = 0
+        other_user = User.objects.create_user('other', 'other@example.com', 'password')
+        for user in (self.dummy_user, other_user):
+            Subscription.objects.create(send_to=user, report=self.report, frequency='Daily',
+                email_subject='shared', time=nowish, start_date=d.today(),
+                report_parameters='test=2014-03-21')
+        call_command('send_scheduled_reports', stdout=StringIO(), stderr=StringIO())
+        close_renderer()
+        self.assertEqual(BrokenPDFBackend.renders, 1)
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(any(s.last_run_succeeded for s in Subscription.objects.all()))
+
+    @override_settings(BASE_PATH='http://testserver', MR_REPORTS_WKHTMLTOPDF_PATH='wkhtmltopdf',
+        MR_REPORTS_PDF_BACKEND='mr_reports.tests.CountingPDFBackend', MR_REPORTS_PDF_CACHE_MAX_MB=1)
+    def test_pdf_cache_across_users(self):
+        """The same report makes the same PDF whoever asks for it, so subscriptions can use
+        PDFs made from the web"""
+        directory = tempfile.mkdtemp()
+        close_renderer()
+        CountingPDFBackend.renders = 0
+        try:
+            with self.settings(MR_REPORTS_PDF_CACHE_DIR=directory):
+                self.client.login(username='dummy', password='password')
+                response = self.client.get(self.report.get_absolute_url() + 'pdf/?test=2014-03-21')
+                self.assertEqual(response.status_code, 200)
+                sched = Subscription.objects.create(send_to=self.dummy_user, report=self.report,
+                    frequency='Daily', email_subject='cached', time=nowish, start_date=d.today(),
+                    report_parameters='test=2014-03-21')
+                self.assertTrue(execute_subscription(sched.pk))
+        finally:
+            close_renderer()
+            shutil.rmtree(directory)
+        self.assertEqual(CountingPDFBackend.renders, 1)
+        self.assertEqual(mail.outbox[0].attachments[0][1], '%PDF')
+
+    @override_settings(BASE_PATH='http://testserver', MR_REPORTS_WKHTMLTOPDF_PATH='wkhtmltopdf',
+        MR_REPORTS_PDF_BACKEND='mr_reports.tests.CountingPDFBackend', MR_REPORTS_PDF_CACHE_MAX_MB=0)
+    def test_parallel_workers(self):
+        """With several workers every due subscription is sent exactly once"""
+        close_renderer()
+        CountingPDFBackend.renders = 0
+        users = [User.objects.create_user('user%s' % i, 'user%s@example.com' % i, 'password') for i in range(6)]
+        for i, user in enumerate(users):
+            Subscription.objects.create(send_to=user, report=self.report, frequency='Daily',
+                email_subject='parallel', time=nowish, start_date=d.today(),
+                report_parameters='test=2014-03-2%s' % (i % 3))
+        #The test database only exists on this thread's connection (an in memory sqlite database
+        #can't be opened again), so share it with the workers and have them take turns using it
+        shared, lock = connections[connection.alias], threading.Lock()
+        shared.allow_thread_sharing = True
+        send_group = SendScheduledReports.send_group
+        def shared_send_group(command, scheds):
+            connections[connection.alias] = shared
+            with lock:
+                send_group(command, scheds)
+        SendScheduledReports.send_group = shared_send_group
+        try:
+            call_command('send_scheduled_reports', workers=2, stdout=StringIO())
+        finally:
+            SendScheduledReports.send_group = send_group
+            shared.allow_thread_sharing = False
+            close_renderer()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(user.email for user in users))
+        self.assertEqual(CountingPDFBackend.renders, 3)
+        self.assertTrue(all(s.last_run_succeeded and not s.lease_owner for s in Subscription.objects.all()))
+
+    def test_lock_subscription(self):
+        """Without SKIP LOCKED support subscriptions are locked with select_for_update"""
+        sched = Subscription.objects.create(send_to=self.dummy_user, report=self.report, frequency='Daily',
+            email_subject='lock', time=nowish, start_date=d.today())
+        self.assertFalse(supports_skip_locked())
+        with transaction.atomic():
+            self.assertEqual(lock_subscription(sched.pk), sched)
+        self.assertRaises(Subscription.DoesNotExist, lock_subscription, sched.pk + 1)
+
+    def test_next_run_at(self):
+        """next_run_at follows the schedule and only due subscriptions are picked up"""
+        sched = Subscription.objects.create(send_to=self.dummy_user, report=self.report, frequency='Monthly',
+            email_subject='next', time=t(6, 0), start_date=d(2014, 1, 15))
+        tz = timezone.get_default_timezone()
+        self.assertEqual(sched.next_run_at, timezone.make_aware(dt(2014, 1, 15, 6, 0), tz))
+        sched.last_scheduled_run = timezone.make_aware(dt(2014, 3, 15, 6, 1), tz)
+        sched.save()
+        self.assertEqual(sched.next_run_at, timezone.make_aware(dt(2014, 4, 15, 6, 0), tz))
+        self.assertFalse(sched.should_send(dt(2014, 3, 15, 6, 5)))
+        self.assertTrue(sched.should_send(dt(2014, 4, 15, 6, 0)))
+        sched.frequency = 'Weekly'
+        sched.save()
+        self.assertEqual(sched.next_run_at, timezone.make_aware(dt(2014, 3, 22, 6, 1), tz))
+        Subscription.objects.create(send_to=self.dummy_user, report=self.report, frequency='Daily',
+            email_subject='later', time=t(6, 0), start_date=d.today() + relativedelta(days=1))
+        self.assertEqual([s.pk for s in Subscription.objects.filter(next_run_at__lte=timezone.now())],
+            [sched.pk])
+
+    @override_settings(TIME_ZONE='America/New_York')
+    def test_next_run_at_daylight_saving(self):
+        """Runs due in the hour skipped or repeated by a daylight saving change still save"""
+        tz = timezone.get_default_timezone()
+        sched = Subscription.objects.create(send_to=self.dummy_user, report=self.report, frequency='Daily',
+            email_subject='dst', time=t(2, 30), start_date=d(2014, 3, 1),
+            last_scheduled_run=tz.localize(dt(2014, 3, 8, 2, 31)))
+        #2:31 doesn't exist on March 9th, the clocks went from 2:00 to 3:00
+        self.assertEqual(sched.next_run_at, tz.localize(dt(2014, 3, 9, 3, 31)))
+        self.assertTrue(sched.should_send(dt(2014, 3, 9, 3, 31)))
+        sched.last_scheduled_run = tz.localize(dt(2014, 11, 1, 1, 31))
+        sched.time = t(1, 30)
+        sched.save()
+        #1:31 happens twice on November 2nd
+        self.assertEqual(sched.next_run_at, tz.localize(dt(2014, 11, 2, 1, 31), is_dst=False))
+        #as can delivery windows ending then
+        sched.deliver_by = t(2, 30)
+        sched.last_scheduled_run = tz.localize(dt(2014, 3, 8, 1, 31))
+        sched.save()
+        self.assertEqual(sched.delivery_deadline(), tz.localize(dt(2014, 3, 9, 3, 30)))
+        #and snapshot refresh times
+        self.assertEqual(last_time_of_day(t(2, 30), tz.localize(dt(2014, 3, 9, 12, 0))),
+            tz.localize(dt(2014, 3, 9, 3, 30)))
+
+    def test_subscription_lease(self):
+        """A claimed subscription can't be claimed again until its lease is released or expires"""
+        sched = Subscription.objects.create(send_to=self.dummy_user, report=self.report, frequency='Daily',
+            email_subject='lease', time=nowish, start_date=d.today())
+        claimed = claim_subscription(sched.pk)
+        self.assertTrue(claimed.lease_owner)
+        self.assertEqual(claim_subscription(sched.pk), None)
+        Subscription.objects.filter(pk=sched.pk).update(lease_expires_at=timezone.now() - relativedelta(seconds=1))
+        reclaimed = claim_subscription(sched.pk)
+        self.assertNotEqual(reclaimed.lease_owner, claimed.lease_owner)
+        #the expired runner finishing doesn't release the new lease
+        finish_subscription(claimed, False)
+        self.assertEqual(Subscription.objects.get(pk=sched.pk).lease_owner, reclaimed.lease_owner)
+        finish_subscription(reclaimed, True, timezone.now())
+        sched = Subscription.objects.get(pk=sched.pk)
+        self.assertEqual((sched.lease_owner, sched.lease_expires_at, sched.last_run_succeeded), ('', None, True))
+        self.assertEqual(claim_subscription(sched.pk), None)
+
+    def test_scheduler_daemon(self):
+        """The daemon keeps a heartbeat and stops cleanly on SIGTERM"""
+        handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        try:
+            call_command('send_scheduled_reports', daemon=True, interval=1, stdout=StringIO())
+        finally:
+            timer.cancel()
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+        heartbeat = SchedulerHeartbeat.objects.get()
+        self.assertFalse(heartbeat.running)
+        self.assertTrue(heartbeat.last_beat >= heartbeat.started_at)
+
+    @override_settings(EMAIL_BACKEND='mr_reports.tests.FlakyEmailBackend')
+    def test_send_email_retry(self):
+        """Emails share a connection, which is reopened if the server drops it, but
+        failures sending aren't retried"""
+        FlakyEmailBackend.opened = FlakyEmailBackend.closed = 0
+        mail_connection = get_connection()
+        for i in range(3):
+            send_email(EmailMessage('test %s' % i, '', 'a@example.com', ['b@example.com']),
+                mail_connection, retries=1)
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+        self.assertEqual([m.subject for m in mail.outbox], ['test 0', 'test 1', 'test 2'])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, send_email,
+            EmailMessage('refused', '', 'a@example.com', ['refused@example.com']), mail_connection)
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+        mail_connection.close()
+        #connections send_email opens itself are closed again
+        FlakyEmailBackend.opened = FlakyEmailBackend.closed = 0
+        send_email(EmailMessage('own', '', 'a@example.com', ['b@example.com']))
+        self.assertEqual((FlakyEmailBackend.opened, FlakyEmailBackend.closed), (1, 1))
+
+    def test_delivery_window(self):
+        """Subscriptions with a delivery window are spread across it and finish on time,
+        and busy connections hold back new subscriptions"""
+        tz = timezone.get_default_timezone()
+        six = timezone.make_aware(dt(2014, 3, 3, 6, 0), tz)
+        scheds = [Subscription.objects.create(send_to=self.dummy_user, report=self.report,
+            frequency='Daily', email_subject='window', time=t(6, 0), deliver_by=t(7, 0),
+            start_date=d(2014, 3, 3), report_parameters='test=%s' % i) for i in range(10)]
+        starts = sorted(scheduling.planned_start(s) for s in scheds)
+        self.assertTrue(starts[0] >= six)
+        self.assertTrue(starts[-1] <= six + relativedelta(minutes=58))
+        self.assertTrue(starts[-1] - starts[0] > datetime.timedelta(minutes=30))
+        start_now, next_start = scheduling.plan([[s] for s in scheds], starts[4])
+        self.assertEqual(len(start_now), 5)
+        self.assertEqual(next_start, starts[5])
+        #slow subscriptions start early enough to make it
+        scheds[0].average_run_seconds = 1200
+        self.assertTrue(scheduling.planned_start(scheds[0]) <= six + relativedelta(minutes=20))
+
+        connection = DataConnection.objects.get(database='sample_test.db')
+        connection.max_concurrent_subscriptions = 1
+        connection.save()
+        claimed = claim_subscription(scheds[0].pk)
+        self.assertTrue(claimed)
+        self.assertEqual(claim_subscription(scheds[1].pk), None)
+        finish_subscription(claimed, True, timezone.now(), 5)
+        self.assertTrue(claim_subscription(scheds[1].pk))
+        self.assertEqual(Subscription.objects.get(pk=scheds[0].pk).average_run_seconds, 5)
+
+    @override_settings(BASE_PATH='http://testserver', MR_REPORTS_WKHTMLTOPDF_PATH='wkhtmltopdf',
+        MR_REPORTS_PDF_BACKEND='mr_reports.tests.CountingPDFBackend', MR_REPORTS_PDF_CACHE_MAX_MB=0)
+    def test_delivery_window_over_days(self):
+        """Start times stay spread across the window day after day, even when runs start
+        late and finish after deliver_by"""
+        close_renderer()
+        tz = timezone.get_default_timezone()
+        for i in range(5):
+            Subscription.objects.create(send_to=self.dummy_user, report=self.report,
+                frequency='Daily', email_subject='window', time=t(6, 0), deliver_by=t(7, 0),
+                start_date=d(2014, 3, 3), report_parameters='test=2014-03-%02d' % (i + 10))
+        for day in range(3):
+            for sched in Subscription.objects.all():
+                start = timezone.make_naive(scheduling.planned_start(sched), tz)
+                self.assertEqual(start.date(), d(2014, 3, 3 + day))
+                self.assertTrue(execute_subscription(sched.pk, today=start + relativedelta(minutes=70)))
+        close_renderer()
+        self.assertEqual(len(mail.outbox), 15)
+        six = timezone.make_aware(dt(2014, 3, 6, 6, 0), tz)
+        scheds = list(Subscription.objects.all())
+        starts = sorted(scheduling.planned_start(s) for s in scheds)
+        self.assertTrue(starts[0] >= six)
+        self.assertTrue(starts[-1] <= six + relativedelta(minutes=58))
+        self.assertTrue(starts[-1] - starts[0] > datetime.timedelta(minutes=20))
+        self.assertEqual(set(s.delivery_deadline() for s in scheds), set([six + relativedelta(hours=1)]))
+        #after missing days only the latest run is made up
+        self.assertTrue(execute_subscription(scheds[0].pk, today=dt(2014, 3, 9, 6, 30)))
+        self.assertEqual(Subscription.objects.get(pk=scheds[0].pk).next_run_at,
+            timezone.make_aware(dt(2014, 3, 10, 6, 0), tz))
+
+    def test_background_report(self):
+        """Background reports are queued, run by run_report_jobs, and shown without re-running"""
+        self.report.run_in_background = True
+        self.report.save()
+        self.client.login(username='dummy', password='password')
+        url = self.report.get_absolute_url()
+        response = self.client.get(url + '?test=2014-03-21')
+        job = ReportJob.objects.get()
+        self.assertEqual(response['Location'], 'http://testserver' + job.get_absolute_url())
+        self.assertContains(self.client.get(job.get_absolute_url()), 'Waiting to run')
+        call_command('run_report_jobs', stdout=StringIO())
+        job = ReportJob.objects.get()
+        self.assertEqual(job.status, 'Done')
+        response = self.client.get(job.get_absolute_url())
+        self.assertEqual(response['Location'], 'http://testserver' + job.result_url())
+        #the data is gone, but the stored results are still shown
+        conn = sqlite3.connect('sample_test.db')
+        conn.execute("DELETE FROM stocks")
+        conn.commit()
+        conn.close()
+        self.assertContains(self.client.get(job.result_url()), 'RHAT')
+        response = self.client.get(url + 'csv/?test=2014-03-21&job=%s' % job.pk)
+        self.assertTrue('RHAT' in ''.join(response.streaming_content))
+        self.assertEqual(ReportJob.objects.count(), 1)
+
+    def test_background_csv_and_purge(self):
+        """Background runs keep results up to the CSV row limit, the same run is re-used
+        when asked for again, and old finished jobs are deleted"""
+        conn = sqlite3.connect('sample_test.db')
+        conn.executemany("INSERT INTO stocks VALUES ('2006-01-06','SELL','IBM',?,80.5)", [(i,) for i in range(5)])
+        conn.commit()
+        conn.close()
+        DataSet.objects.filter(name='test').update(max_rows=1, csv_max_rows=3)
+        self.report.run_in_background = True
+        self.report.save()
+        self.client.login(username='dummy', password='password')
+        self.client.get(self.report.get_absolute_url() + 'csv/?test=2014-03-21')
+        call_command('run_report_jobs', stdout=StringIO())
+        job = ReportJob.objects.get()
+        self.assertEqual(job.format, 'csv')
+        self.assertEqual(len(job.get_all_data(export_csv=True)[0][1]), 3)
+        ReportJob.objects.filter(pk=job.pk).update(finished_at=timezone.now() - relativedelta(days=8))
+        call_command('run_report_jobs', stdout=StringIO())
+        self.assertEqual(ReportJob.objects.count(), 0)
+        #a web run shows the web row limit, but its CSV link has up to the CSV limit
+        url = self.report.get_absolute_url() + '?test=2014-03-21'
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(ReportJob.objects.count(), 1)
+        call_command('run_report_jobs', stdout=StringIO())
+        job = ReportJob.objects.get()
+        dataset, data, columns = job.get_all_data()[0]
+        self.assertEqual((len(data), dataset.truncated_at), (1, 1))
+        self.assertEqual(self.client.get(url)['Location'], 'http://testserver' + job.get_absolute_url())
+        response = self.client.get(self.report.get_absolute_url() + 'csv/?test=2014-03-21&job=%s' % job.pk)
+        self.assertEqual(len(list(response.streaming_content)), 5)
+        self.assertEqual(ReportJob.objects.count(), 1)
+
+    def test_materialized_dataset(self):
+        """Materialized datasets read from their snapshot until it's refreshed"""
+        conn = sqlite3.connect('sample_test.db')
+        conn.execute("INSERT INTO stocks VALUES ('2006-01-06','SELL','IBM',50,80.5)")
+        conn.commit()
+        dataset = DataSet.objects.get(name='test')
+        dataset.materialized = True
+        dataset.sortable = True
+        dataset.page_size = 1
+        dataset.save()
+        data, columns = dataset.run_query(None)
+        self.assertEqual(len(data), 2)
+        self.assertTrue(dataset.snapshot_at)
+        conn.execute("DELETE FROM stocks")
+        conn.commit()
+        conn.close()
+        dataset.set_table_state({dataset.sort_param(): '-3', dataset.page_param(): '2'})
+        data, columns = dataset.run_query(None)
+        self.assertEqual([row[2] for row in data], [u'IBM'])
+        self.assertFalse(dataset.has_next_page)
+        self.assertEqual(DataSetSnapshot.objects.count(), 1)
+        #not due until the refresh time comes around again
+        snapshot = DataSetSnapshot.objects.get()
+        dataset.snapshot_refresh_time = (timezone.localtime(snapshot.refreshed_at)
+            - relativedelta(minutes=1)).time()
+        DataSet.objects.filter(pk=dataset.pk).update(snapshot_refresh_time=dataset.snapshot_refresh_time)
+        self.assertFalse(DataSetSnapshot.objects.get().is_due())
+        self.assertTrue(DataSetSnapshot.objects.get().is_due(snapshot.refreshed_at + relativedelta(days=1)))
+        #refreshed once when due, not on every check after
+        DataSetSnapshot.objects.update(refreshed_at=snapshot.refreshed_at - relativedelta(days=1))
+        self.assertEqual(DataSetSnapshot.refresh_due(), 1)
+        self.assertEqual(DataSetSnapshot.refresh_due(), 0)
+        dataset.set_table_state({})
+        self.assertEqual(dataset.run_query(None)[0], [])
+        #a refresh time is required
+        dataset.snapshot_refresh_time = None
+        self.assertRaises(ValidationError, dataset.clean)
+        #snapshots nobody has looked at in a while are deleted
+        DataSetSnapshot.objects.update(last_used_at=timezone.now() - relativedelta(days=8))
+        self.assertEqual(DataSetSnapshot.refresh_due(), 0)
+        self.assertEqual(DataSetSnapshot.objects.count(), 0)
+
+    def test_materialized_dataset_limits_and_failures(self):
+        """Snapshots keep rows up to the CSV limit, and a failed refresh waits for the next
+        refresh time"""
+        conn = sqlite3.connect('sample_test.db')
+        conn.execute("INSERT INTO stocks VALUES ('2006-01-06','SELL','IBM',50,80.5)")
+        conn.commit()
+        conn.close()
+        dataset = DataSet.objects.get(name='test')
+        dataset.materialized = True
+        dataset.max_rows = 1
+        dataset.snapshot_refresh_time = t(0, 0)
+        dataset.save()
+        data, columns = dataset.run_query(None)
+        self.assertEqual((len(data), dataset.truncated_at), (1, 1))
+        rows, columns = dataset.iter_query(None)
+        self.assertEqual(len(list(rows)), 2)
+        self.assertEqual(DataSetSnapshot.objects.count(), 1)
+        #a failing refresh doesn't stop the others, and isn't tried again until the next refresh time
+        DataSet.objects.filter(pk=dataset.pk).update(query="SELECT * FROM missing")
+        DataSetSnapshot.objects.update(refreshed_at=timezone.now() - relativedelta(days=1))
+        DataSet.objects.create(name='broken', connection=dataset.connection, query="SELECT * FROM missing",
+            materialized=True, snapshot_refresh_time=t(0, 0))
+        DataSet.objects.create(name='working', connection=dataset.connection, query="SELECT * FROM stocks",
+            materialized=True, snapshot_refresh_time=t(0, 0))
+        self.assertEqual(DataSetSnapshot.refresh_due(), 1)
+        self.assertEqual(DataSetSnapshot.objects.filter(refresh_failed_at__isnull=False).count(), 2)
+        self.assertFalse(any(s.is_due() for s in DataSetSnapshot.objects.all()))
+        self.assertTrue(all(s.is_due(timezone.now() + relativedelta(days=1))
+            for s in DataSetSnapshot.objects.filter(refresh_failed_at__isnull=False)))
+        self.assertEqual(DataSetSnapshot.refresh_due(), 0)
+
     ### Things we don't expect to be sent:
     def test_sched_calc_1(self):
         """23 hours after last run"""
@@ -7,5 +7,7 @@ urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
     # ex: /reports/5/
     url(r'^(?P<report_id>\d+)/$', views.report, name='report'),
+    # ex: /reports/5/job/12/
+    url(r'^(?P<report_id>\d+)/job/(?P<job_id>\d+)/$', views.job_status, name='job_status'),
     url(r'^(?P<report_id>\d+)/(?P<format>\w+)/$', views.report, name='report'),
 )
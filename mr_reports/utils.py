@@ -3,58 +3,233 @@
 Re-usable generic functions, and handling special tasks like emailing reports
 """
 import datetime
+import os
 import re
+import smtplib
+import socket
+import sys
+import time
+import urllib
+import uuid
 
 from django.test.client import Client
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.http import QueryDict, HttpRequest
-from django.db import transaction
+from django.db import transaction, connection
 from django.utils import timezone
 
-from models import Report, Subscription, Parameter
+from models import Report, Subscription, Parameter, DataConnection
 from views import render_report
 from django.conf import settings
 
-# Keep all DB access for a given Subscription within one txn to potentially allow 
-# multiple concurrent Subscription runners.
-@transaction.atomic
-def execute_subscription(sched_id, force_run=False, today=None):
+def normalize_parameters(report_parameters):
+    """Put a subscription's report_parameters query string in a standard form, so
+    subscriptions asking for the same report output can be recognized"""
+    query = QueryDict(report_parameters.lstrip('?'))
+    return urllib.urlencode(sorted(query.lists()), doseq=True)
+
+def subscription_group(sched_obj):
+    """Subscriptions with the same group get the same PDF"""
+    return (sched_obj.report_id, normalize_parameters(sched_obj.report_parameters))
+
+def render_subscription_pdf(sched_obj):
+    """Run the subscription's report and return the PDF response"""
+    mock_request = HttpRequest()
+    mock_request.method = 'GET'
+    if sched_obj.report_parameters:
+        mock_request.GET = QueryDict(sched_obj.report_parameters.lstrip('?'))
+    else:
+        #If the report has parameters and none are provided, provide dummy GET data
+        if Parameter.objects.filter(dataset__report=sched_obj.report):
+            mock_request.GET = QueryDict('use_defaults')
+
+    return render_report(mock_request, report_id=sched_obj.report.pk, format='pdf')
+
+def supports_skip_locked():
+    """Whether the database can skip rows other transactions have locked
+    (PostgreSQL 9.5+, MySQL 8.0.1+)"""
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'mysql':
+        return connection.mysql_version >= (8, 0, 1)
+    return False
+
+def lock_subscription(sched_id):
+    """Lock a Subscription's row for the rest of the transaction and return it.
+
+    Returns None if another runner already has it locked, where the database supports
+    SKIP LOCKED.  Otherwise this waits for the other runner to finish with it."""
+    if supports_skip_locked():
+        quote_name = connection.ops.quote_name
+        rows = list(Subscription.objects.raw('SELECT * FROM %s WHERE %s = %%s FOR UPDATE SKIP LOCKED'
+            % (quote_name(Subscription._meta.db_table), quote_name(Subscription._meta.pk.column)),
+            [sched_id]))
+        return rows[0] if rows else None
+    return Subscription.objects.select_for_update().get(pk=sched_id)
+
+def connections_busy(sched_obj, now):
+    """Whether any DataConnection the subscription's report uses already has its
+    max_concurrent_subscriptions running (counting unexpired leases)"""
+    limited = DataConnection.objects.filter(dataset__report=sched_obj.report_id,
+        max_concurrent_subscriptions__isnull=False).distinct()
+    for data_connection in limited:
+        running = Subscription.objects.filter(lease_expires_at__gt=now,
+            report__datasets__connection=data_connection).exclude(pk=sched_obj.pk).distinct().count()
+        if running >= data_connection.max_concurrent_subscriptions:
+            return True
+    return False
+
+def claim_subscription(sched_id, force_run=False, today=None, rendered=None):
+    """Take a lease on a Subscription that's due to be sent, in a short transaction.
+
+    Returns the Subscription, with lease_owner set, or None if it isn't due, another
+    runner holds an unexpired lease on it, or one of its data connections is at its
+    max_concurrent_subscriptions (unless its PDF is already in 'rendered', see
+    execute_subscription).  Leases expire after MR_REPORTS_SUBSCRIPTION_LEASE_SECONDS,
+    so a runner that dies mid-send doesn't keep the subscription forever."""
+    with transaction.atomic():
+        sched_obj = lock_subscription(sched_id)
+        if sched_obj is None:
+            #another runner is claiming it right now
+            return None
+        now = timezone.now()
+        if sched_obj.lease_expires_at and sched_obj.lease_expires_at > now:
+            return None
+        #check whether we should send
+        if not force_run and not sched_obj.should_send(today=today):
+            return None
+        if not force_run and subscription_group(sched_obj) not in (rendered or {}) \
+                and connections_busy(sched_obj, now):
+            return None
+        sched_obj.lease_owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        sched_obj.lease_expires_at = now + datetime.timedelta(
+            seconds=getattr(settings, 'MR_REPORTS_SUBSCRIPTION_LEASE_SECONDS', 1800))
+        Subscription.objects.filter(pk=sched_obj.pk).update(lease_owner=sched_obj.lease_owner,
+            lease_expires_at=sched_obj.lease_expires_at)
+    return sched_obj
+
+def finish_subscription(sched_obj, succeeded, ran_at=None, seconds=None):
+    """Record the outcome of a claimed Subscription and release its lease, in a short
+    transaction.  ran_at is stored as the last scheduled run (see
+    Subscription.current_occurrence; leave it out for forced runs) and seconds is how
+    long the run took.  Failed runs stay due so they're retried."""
+    with transaction.atomic():
+        current = Subscription.objects.select_for_update().get(pk=sched_obj.pk)
+        current.last_run_succeeded = succeeded
+        if succeeded and ran_at:
+            current.last_scheduled_run = ran_at
+        if succeeded and seconds is not None:
+            current.record_run_seconds(seconds)
+        #Don't release a lease another runner took over after ours expired
+        if current.lease_owner == sched_obj.lease_owner:
+            current.lease_owner = ''
+            current.lease_expires_at = None
+        current.save()
+
+#Failures connecting to the mail server, which are worth another try
+CONNECTION_ERRORS = (socket.error, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected)
+
+def _check_connection(mail_connection):
+    """Make sure the server hasn't dropped an SMTP connection that's been sitting open
+    (for the SMTP backend; others are taken as they are)"""
+    smtp = getattr(mail_connection, 'connection', None)
+    if smtp is not None and smtp.noop()[0] != 250:
+        raise smtplib.SMTPServerDisconnected("Mail server connection is no longer usable")
+
+def send_email(msg, mail_connection=None, retries=None):
+    """Send msg, retrying up to MR_REPORTS_EMAIL_RETRIES times if the mail server can't
+    be reached.
+
+    mail_connection is an optional connection from django.core.mail.get_connection() to
+    share between messages (so each doesn't log in to the mail server again).  It's
+    checked before sending, and closed and reopened if the server dropped it.
+
+    Only connecting is retried: once sending starts the server may have accepted the
+    message, so a failure after that is raised rather than risk sending it twice."""
+    opened_here = mail_connection is None
+    if opened_here:
+        mail_connection = get_connection()
+    if retries is None:
+        retries = getattr(settings, 'MR_REPORTS_EMAIL_RETRIES', 2)
+    try:
+        for attempt in xrange(retries + 1):
+            try:
+                #opening first keeps it open after sending
+                mail_connection.open()
+                _check_connection(mail_connection)
+                break
+            except CONNECTION_ERRORS:
+                if attempt == retries:
+                    raise
+                try:
+                    mail_connection.close()
+                except Exception:
+                    pass
+                time.sleep(attempt + 1)
+        if not mail_connection.send_messages([msg]):
+            raise ValueError("Email to %s was not sent" % ', '.join(msg.to))
+    finally:
+        if opened_here:
+            try:
+                mail_connection.close()
+            except Exception:
+                pass
+
+def execute_subscription(sched_id, force_run=False, today=None, rendered=None, mail_connection=None):
     """Handles creating the report PDF and sending the email.
-    (A future optimzation could re-use the PDF if multiple Subscriptions of 
-    the same report are running at the same time.)
 
     'today' defaults to current day, but you can set different dates for testing.
 
+    'rendered' is an optional dict to share PDFs between subscriptions in the same
+    subscription_group (see send_scheduled_reports), so each distinct report is only
+    generated once.
+
+    'mail_connection' is an optional open mail connection to send with, see send_email.
+
     This accepts the ID instead of the object itself in order to handle concurrancy issues.
+    The subscription is claimed with a lease (see claim_subscription) so several runners
+    can work at once, and no transaction is held open while the report runs and sends.
 
     (It would seem to make sense to put this method with the Subscription model, however it leads to 
     some circular imports so it was cleaner to break it out into a utility function)."""
 
-    #Locks record until this function completes
-    sched_obj = Subscription.objects.select_for_update().get(pk=sched_id)
+    sched_obj = claim_subscription(sched_id, force_run=force_run, today=today, rendered=rendered)
+    if sched_obj is None:
+        return False
+    ran_at = None if force_run else sched_obj.current_occurrence(today=today)
+    started = time.time()
 
-    #check whether we should send
-    if not force_run:
-        if not sched_obj.should_send(today=today):
-            return False
-        sched_obj.last_scheduled_run = timezone.localtime(timezone.now())
-    
+    try:
+        _send_subscription(sched_obj, rendered, mail_connection)
+    except:
+        exc_info = sys.exc_info()
+        finish_subscription(sched_obj, False)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    finish_subscription(sched_obj, True, ran_at, time.time() - started)
+    return True
+
+def _send_subscription(sched_obj, rendered, mail_connection):
     if not getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_PATH','') and getattr(settings, 'BASE_PATH',''):
-        sched_obj.last_run_succeeded = False
-        sched_obj.save()
         raise ValueError("PDF generation not available. Please add and set 'MR_REPORTS_WKHTMLTOPDF_PATH', and 'BASE_PATH' in your settings.py file.")
 
-    #Generate PDF
-    mock_request = HttpRequest()
-    mock_request.method = 'GET'
-    if sched_obj.report_parameters:
-        mock_request.GET = QueryDict(sched_obj.report_parameters.lstrip('?'))
-    else:
-        #If the report has parameters and none are provided, provide dummy GET data
-        if Parameter.objects.filter(dataset__report=sched_obj.report):
-            mock_request.GET = QueryDict('use_defaults')
-
-    response = render_report(mock_request, report_id=sched_obj.report.pk, format='pdf')
+    #Generate PDF, or re-use the one made for another subscription in the same group
+    if rendered is None:
+        rendered = {}
+    group = subscription_group(sched_obj)
+    if group not in rendered:
+        try:
+            response = render_subscription_pdf(sched_obj)
+        except Exception, e:
+            #the rest of the group would fail the same way, so don't render it again
+            rendered[group] = e
+            raise
+        if response.status_code != 200:
+            rendered[group] = ValueError("PDF generation failed: %s" % response.content)
+        else:
+            rendered[group] = response
+    response = rendered[group]
+    if isinstance(response, Exception):
+        raise response
 
     #Send email
     full_url = settings.BASE_PATH.rstrip('/') + sched_obj.report.get_absolute_url()
@@ -74,7 +249,4 @@ Go here to view the realtime version of the report and/or change your subscripti
     msg = EmailMultiAlternatives(subject, text_content, sched_obj.send_to.email, [sched_obj.send_to.email])
     msg.attach_alternative(html_content, "text/html")
     msg.attach(sched_obj.report.filename()+'.pdf', response.content, response['Content-Type'])
-    msg.send()
-    sched_obj.last_run_succeeded = True
-    sched_obj.save()
-    return True
+    send_email(msg, mail_connection)
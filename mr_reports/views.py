@@ -1,22 +1,25 @@
 
 import datetime
 import csv
-import subprocess
 
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.template import RequestContext, loader
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse, Http404
 from django import forms
 from django.forms import ModelForm
 from django.forms.models import modelformset_factory
 from django.forms.forms import Form
 import django.forms.fields
 from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 import django.core.exceptions
 
 from models import Report, Parameter, DataSet, ReportDataSet, DataSetParameter, \
-    Subscription
+    Subscription, ReportJob
+import plans
+from pdf import get_pdf_cache, get_renderer, PDFRenderError, PDFRenderTimeout, PDFRenderBusy
 
 
 def index(request):
@@ -33,25 +36,9 @@ def index(request):
 
 def build_parameter_form(report):
     """Dynamically build a form class to handle the report's parameters"""
-    all_parameters = []
-    for dataset in report.datasets.all():
-        #Find 'order_on_report' value for this dataset/report
-        order_on_report = ReportDataSet.objects.get(report=report, dataset=dataset).order_on_report
-        for p in dataset.parameters.all():
-            #find 'order_on_form' value for this parameter and dataset
-            order_on_form = DataSetParameter.objects.get(dataset=dataset, parameter=p).order_on_form            
-            all_parameters.append((p,(order_on_report, order_on_form)))
-    all_parameters = sorted(all_parameters, key=lambda x: (x[1][0],x[1][1]))
-    #remove sorting fields
-    all_parameters = [v[0] for v in all_parameters]
-
-    if all_parameters:
-        #remove duplicates whilst preserving order
-        unique_parameters = []
-        [unique_parameters.append(item) for item in all_parameters if item not in unique_parameters]
-
-
+    unique_parameters = report.get_parameters()
 
+    if unique_parameters:
         #build the form
         class ParameterForm(Form):
             def __init__(self, *args, **kwargs):
@@ -98,15 +85,54 @@ SubscriptionFormSet = modelformset_factory(Subscription, fields = (
             'report_parameters': forms.TextInput(attrs={'style':"width:14em"}),
         })
 
-def data_to_csv(response, datasets):
-    w=csv.writer(response,dialect='excel')
+def add_table_links(request, datasets):
+    """Give each dataset the links it needs for paging and sorting.  Page and sort
+    state live in the query string (see DataSet.set_table_state)."""
+    for dataset, data, columns in datasets:
+        query = request.GET.copy()
+        query.pop('refresh', None)
+        if dataset.page:
+            if dataset.page > 1:
+                query[dataset.page_param()] = dataset.page - 1
+                dataset.previous_page_url = '?' + query.urlencode()
+            if dataset.has_next_page:
+                query[dataset.page_param()] = dataset.page + 1
+                dataset.next_page_url = '?' + query.urlencode()
+        if dataset.can_sort():
+            #Changing the sort order starts back at the first page
+            query.pop(dataset.page_param(), None)
+            dataset.headers = []
+            for i, column in enumerate(columns, 1):
+                arrow = ''
+                if dataset.sort == i:
+                    arrow, query[dataset.sort_param()] = 'up', -i
+                elif dataset.sort == -i:
+                    arrow, query[dataset.sort_param()] = 'down', i
+                else:
+                    query[dataset.sort_param()] = i
+                dataset.headers.append((column, '?' + query.urlencode(), arrow))
+
+class Echo(object):
+    """File-like object that hands back whatever is written to it, so csv.writer
+    can produce one line at a time for a streaming response"""
+    def write(self, value):
+        return value
+
+def data_to_csv(datasets):
+    """Generate CSV lines for (dataset, rows, columns) tuples, where rows can be any
+    iterable (such as from Report.iter_all_data)"""
+    w=csv.writer(Echo(),dialect='excel')
     for i,(dataset,data,columns) in enumerate(datasets):
         if i>0:
             #a row of padding between data sets
-            w.writerows([['' for col in columns]])
-        w.writerows([[s.encode("utf-8") for s in columns]])
-        w.writerows(data)
-    return response
+            yield w.writerow(['' for col in columns])
+        yield w.writerow([s.encode("utf-8") for s in columns])
+        for row in data:
+            yield w.writerow(row)
+        if dataset.timed_out:
+            yield w.writerow(['(Query cancelled after taking longer than %s seconds)' % dataset.timed_out])
+        if dataset.truncated_at:
+            yield w.writerow(['(Results truncated at %s rows)' % dataset.truncated_at])
 
 def output_pdf(request, context_from_view, report):
     """Return a PDF version of report.  This is really required to be run from the 
@@ -117,28 +143,81 @@ def output_pdf(request, context_from_view, report):
     if not getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_PATH','') and getattr(settings, 'BASE_PATH',''):
         return HttpResponse("PDF generation not available. Please add and set 'MR_REPORTS_WKHTMLTOPDF_PATH', and 'BASE_PATH' in your settings.py file.")
     #Render normal page HTML, and feed it to WKHTMLTOPDF
-    command = [getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_PATH')]
-    command += getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_OPTIONS',[])
-    command += ['--page-size', report.pdf_paper_size, '--orientation', report.pdf_orientation]
-    command += ["-","-"] #"-" to tell WKHTMLTOPDF to use pipes for input and output
-    #print ' '.join(command)
-    wkhtml2pdf = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    options = ['--page-size', report.pdf_paper_size, '--orientation', report.pdf_orientation]
     template = loader.get_template('mr_reports/report.html')
     html = template.render(context_from_view).encode('utf8')
-    wkdata = wkhtml2pdf.communicate(html)
-    pdf = wkdata[0];
+    renderer = get_renderer()
+
+    #Re-use the PDF if this exact report has been rendered before.  (The template leaves
+    #out the user, the time, links and the CSRF token for PDFs so this can match.)
+    pdf_cache = get_pdf_cache()
+    pdf = None
+    if pdf_cache:
+        key = pdf_cache.key(html, [renderer.backend.__class__.__name__]
+            + getattr(settings, 'MR_REPORTS_WKHTMLTOPDF_OPTIONS', []) + options)
+        pdf = pdf_cache.get(key)
+    if pdf is None:
+        try:
+            pdf = renderer.render(html, options)
+        except PDFRenderBusy, e:
+            return HttpResponse(str(e), status=503)
+        except PDFRenderError, e:
+            return HttpResponse(str(e), status=504 if isinstance(e, PDFRenderTimeout) else 500)
+        if pdf_cache:
+            pdf_cache.put(key, pdf)
     response = HttpResponse(content_type='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=%s.pdf' % report.filename()
     response.write(pdf)
     return response
 
+def start_report_job(request, report, format):
+    """Queue a background run of report (see Report.run_in_background) and send the
+    user to its status page.  A run of the same report for the same user that's still
+    waiting or running, or finished in the last MR_REPORTS_JOB_REUSE_SECONDS, is used
+    instead of queueing another (so reloading doesn't run it again)."""
+    query = request.GET.copy()
+    query.pop('job', None)
+    if not request.user.is_staff:
+        query.pop('refresh', None)
+    user = request.user if request.user.is_authenticated() else None
+    parameters = query.urlencode()
+    same = ReportJob.objects.filter(report=report, user=user, parameters=parameters, format=format)
+    reusable = Q(status__in=('Queued', 'Running'))
+    if 'refresh' not in query:
+        recent = timezone.now() - datetime.timedelta(
+            seconds=getattr(settings, 'MR_REPORTS_JOB_REUSE_SECONDS', 300))
+        reusable |= Q(status='Done', finished_at__gte=recent)
+    job = same.filter(reusable).first()
+    if job is None:
+        job = ReportJob.objects.create(report=report, user=user, parameters=parameters, format=format)
+    return HttpResponseRedirect(job.get_absolute_url())
+
 def render_report(request, report_id, format=''):
     """Render a given report, or ask for parameters if needed
 
     A utils.execute_subscription also runs this function using a mock request object
     so don't always expect request to contain things like user, etc.
     """
-    report = get_object_or_404(Report, pk=report_id)
+    try:
+        report, ParameterForm = plans.get_report_plan(report_id)
+    except Report.DoesNotExist:
+        raise Http404
+
+    #Show the results of a finished background run instead of running the report
+    job = None
+    if request.GET.get('job'):
+        job_id = request.GET['job']
+        if not job_id.isdigit():
+            raise Http404
+        job = get_object_or_404(ReportJob, pk=job_id, report=report.pk)
+        if job.user_id and job.user_id != getattr(getattr(request,'user',None),'id',None):
+            raise Http404
+        if job.status != 'Done':
+            return HttpResponseRedirect(job.get_absolute_url())
+    #Web requests for background reports are queued for run_report_jobs
+    #(subscriptions, which use a mock request with no user, still run here)
+    run_in_background = report.run_in_background and not job and getattr(request,'user',False) \
+        and request.method == 'GET'
 
     subscriptions, subscription_formset, subscribe_parameters, show_subscription_form = [], None, '', False
 
@@ -148,16 +227,33 @@ def render_report(request, report_id, format=''):
     base_path = ''
     datasets = []
 
+    #Staff can skip cached results and re-run the queries
+    can_refresh = getattr(request,'user',False) and request.user.is_staff
+    use_cache = not (can_refresh and request.GET.get('refresh'))
+    if 'refresh' in request.GET:
+        query = request.GET.copy()
+        del query['refresh']
+        curr_url = request.path + ('?' + query.urlencode() if query else '')
+    refresh_query = request.GET.copy()
+    refresh_query['refresh'] = '1'
+    refresh_query.pop('job', None)
+    refresh_url = request.path + '?' + refresh_query.urlencode()
+
     #If form exists, and is not bound, or is not valid, prompt for parameters
     #otherwise render report
-    ParameterForm = build_parameter_form(report)
     prompt_for_parameters = False
     if ParameterForm:
         if request.GET:
             parameter_form = ParameterForm(request.GET)
             if parameter_form.is_valid():
-                #render report
-                datasets = report.get_all_data(parameter_form)
+                if run_in_background:
+                    return start_report_job(request, report, format)
+                #render report (CSV streams its data below instead)
+                if job:
+                    datasets = job.get_all_data(export_csv=format == 'csv')
+                elif format != 'csv':
+                    datasets = report.get_all_data(parameter_form, use_cache=use_cache,
+                        table_state=request.GET, paginate=not format)
                 #Include links to PDF and CSV versions of report
                 if '?' in curr_url:
                     csv_url = ''.join([curr_url.split('?')[0],'csv/?',curr_url.split('?')[1]])
@@ -173,10 +269,20 @@ def render_report(request, report_id, format=''):
     else:
         #render report
         parameter_form = None
-        datasets = report.get_all_data(parameter_form)
+        if run_in_background:
+            return start_report_job(request, report, format)
+        if job:
+            datasets = job.get_all_data(export_csv=format == 'csv')
+        elif format != 'csv':
+            datasets = report.get_all_data(parameter_form, use_cache=use_cache,
+                table_state=request.GET, paginate=not format)
         #Include links to PDF and CSV versions of report
-        csv_url = curr_url + 'csv/'
-        pdf_url = curr_url + 'pdf/'
+        if '?' in curr_url:
+            path, query = curr_url.split('?', 1)
+            csv_url, pdf_url = path + 'csv/?' + query, path + 'pdf/?' + query
+        else:
+            csv_url = curr_url + 'csv/'
+            pdf_url = curr_url + 'pdf/'
 
     #pull subscriptions if any, handle saving
     if getattr(request,'user',False):
@@ -206,10 +312,14 @@ def render_report(request, report_id, format=''):
 
     #Handle alternative outputs
     if format=='csv':
-        assert datasets and not prompt_for_parameters
-        response = HttpResponse(content_type='text/csv')
+        assert not prompt_for_parameters
+        if job:
+            rows = data_to_csv(datasets)
+        else:
+            rows = data_to_csv(report.iter_all_data(parameter_form, use_cache=use_cache,
+                table_state=request.GET))
+        response = StreamingHttpResponse(rows, content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="%s.csv"' % report.filename()
-        response = data_to_csv(response,datasets)
         return response
     elif format=='pdf':
         assert datasets and not prompt_for_parameters
@@ -218,6 +328,7 @@ def render_report(request, report_id, format=''):
         return output_pdf(request, context, report)
     else:
         #normal page render
+        add_table_links(request, datasets)
         return render(request, 'mr_reports/report.html', locals())
 
 @login_required
@@ -225,3 +336,17 @@ def report(request, report_id, format=''):
     """Render a report for the web"""
     return render_report(request, report_id, format)
 
+@login_required
+def job_status(request, report_id, job_id):
+    """Waiting page for a background report run.  It reloads itself until the report
+    is done, then goes to the report."""
+    job = get_object_or_404(ReportJob, pk=job_id, report=report_id)
+    if job.user_id and job.user_id != request.user.id:
+        raise Http404
+    if job.status == 'Done':
+        return HttpResponseRedirect(job.result_url())
+    report = job.report
+    footer_html = getattr(settings,'MR_REPORTS_FOOTER_HTML',
+        "<p><em>Generated by <a href=''>Mr. Reports</a>.</em></p>")
+    return render(request, 'mr_reports/job_status.html', locals())
+